@@ -0,0 +1,105 @@
+import collections
+import struct
+import zlib
+
+try:
+  import zstandard as zstd
+except ImportError:
+  zstd = None
+
+try:
+  import lz4.frame as lz4f
+except ImportError:
+  lz4f = None
+
+from . import alog
+from . import assert_checks as tas
+
+
+# Compressed blocks are self describing, as they carry a small header with the codec
+# used to compress them, and the size of the uncompressed data. Each block is
+# compressed independently, so random access at block granularity is preserved.
+MAGIC = b'GFSZBLK1'
+_HEADER = struct.Struct('<8sBQ')
+
+Codec = collections.namedtuple('Codec', 'id, name, compress, decompress')
+
+_CODECS = dict()
+
+def _register(codec):
+  _CODECS[codec.id] = codec
+  _CODECS[codec.name] = codec
+
+
+if zstd is not None:
+  _register(Codec(id=1,
+                  name='zstd',
+                  compress=lambda data: zstd.ZstdCompressor(level=3).compress(data),
+                  decompress=lambda data, size: zstd.ZstdDecompressor().decompress(
+                    data, max_output_size=size)))
+
+if lz4f is not None:
+  _register(Codec(id=2,
+                  name='lz4',
+                  compress=lambda data: lz4f.compress(data),
+                  decompress=lambda data, size: lz4f.decompress(data)))
+
+_register(Codec(id=3,
+                name='zlib',
+                compress=lambda data: zlib.compress(data, level=1),
+                decompress=lambda data, size: zlib.decompress(data, bufsize=size)))
+
+
+def get_codec(name):
+  if name == 'auto':
+    for cname in ('zstd', 'lz4', 'zlib'):
+      if (codec := _CODECS.get(cname)) is not None:
+        return codec
+
+  codec = _CODECS.get(name)
+  if codec is None:
+    alog.xraise(ValueError, f'Unknown (or not available) compression codec: {name}')
+
+  return codec
+
+
+def sample_ratio(codec, data, nsamples=4, sample_size=64 * 1024):
+  # Estimates the compression ratio of the data by compressing a few evenly spaced
+  # samples of it, instead of the whole data.
+  step = max(len(data) // nsamples, sample_size)
+  raw_size = comp_size = 0
+  for offset in range(0, len(data), step):
+    sample = data[offset: offset + sample_size]
+    raw_size += len(sample)
+    comp_size += len(codec.compress(sample))
+
+  return comp_size / raw_size if raw_size > 0 else 1.0
+
+
+def encode(codec, data):
+  return _HEADER.pack(MAGIC, codec.id, len(data)) + codec.compress(data)
+
+
+def is_encoded(data, size):
+  # A raw block can happen to start with the magic too, but it would not be shorter
+  # than its length while also carrying it within the header.
+  if len(data) < _HEADER.size or len(data) >= size:
+    return False
+
+  magic, codec_id, dsize = _HEADER.unpack_from(data)
+
+  return magic == MAGIC and dsize == size
+
+
+def decode(data):
+  magic, codec_id, size = _HEADER.unpack_from(data)
+  tas.check_eq(magic, MAGIC, msg=f'Invalid compressed block header')
+
+  codec = _CODECS.get(codec_id)
+  if codec is None:
+    alog.xraise(ValueError, f'Compressed block codec not available: {codec_id}')
+
+  ddata = codec.decompress(data[_HEADER.size:], size)
+  tas.check_eq(len(ddata), size, msg=f'Corrupted compressed block')
+
+  return ddata
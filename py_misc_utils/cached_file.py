@@ -2,19 +2,26 @@ import collections
 import datetime
 import functools
 import hashlib
+import io
 import os
 import re
 import shutil
+import threading
 import time
+import urllib.parse as uparse
 import yaml
 
 from . import alog
 from . import assert_checks as tas
+from . import block_compress as bcomp
 from . import core_utils as cu
+from . import executor as xe
 from . import file_overwrite as fow
 from . import fin_wrap as fw
 from . import fs_utils as fsu
+from . import global_namespace as gns
 from . import lockfile as lockf
+from . import mmap as mm
 from . import no_except as nox
 from . import obj
 from . import osfd
@@ -28,14 +35,320 @@ class Meta(obj.Obj):
   pass
 
 
+BlockCacheStats = collections.namedtuple(
+  'BlockCacheStats', 'hits, misses, size, max_size, count',
+)
+
+class _BlockLRU:
+
+  def __init__(self, max_size):
+    self._max_size = max_size
+    self._lock = threading.Lock()
+    self._blocks = collections.OrderedDict()
+    self._size = 0
+    self._hits = 0
+    self._misses = 0
+
+  def get(self, key):
+    with self._lock:
+      data = self._blocks.get(key)
+      if data is not None:
+        self._blocks.move_to_end(key)
+        self._hits += 1
+      else:
+        self._misses += 1
+
+      return data
+
+  def contains(self, key):
+    with self._lock:
+      return key in self._blocks
+
+  def put(self, key, data):
+    size = len(data)
+    if size <= self._max_size:
+      with self._lock:
+        if (xdata := self._blocks.pop(key, None)) is not None:
+          self._size -= len(xdata)
+
+        self._blocks[key] = data
+        self._size += size
+        while self._size > self._max_size:
+          _, xdata = self._blocks.popitem(last=False)
+          self._size -= len(xdata)
+
+  def clear(self):
+    with self._lock:
+      self._blocks.clear()
+      self._size = 0
+
+  def stats(self):
+    with self._lock:
+      return BlockCacheStats(hits=self._hits,
+                             misses=self._misses,
+                             size=self._size,
+                             max_size=self._max_size,
+                             count=len(self._blocks))
+
+
+_MEMCACHE_MAXSIZE = int(os.getenv('GFS_MEMCACHE_MAXSIZE', 256 * 1024**2))
+
+_BLOCK_LRU = gns.Var(f'{__name__}.BLOCK_LRU',
+                     fork_init=True,
+                     defval=lambda: _BlockLRU(_MEMCACHE_MAXSIZE))
+
+def _block_lru():
+  return gns.get(_BLOCK_LRU)
+
+
+def block_cache_stats():
+  return _block_lru().stats()
+
+
+def clear_block_cache():
+  _block_lru().clear()
+
+
+Span = collections.namedtuple('Span', 'offset, size, indices')
+
+def coalesce_ranges(ranges, max_gap=0):
+  spans, start, end, indices = [], None, None, []
+  for i in sorted(range(len(ranges)), key=lambda i: ranges[i][0]):
+    offset, size = ranges[i]
+    if start is not None and offset <= end + max_gap:
+      end = max(end, offset + size)
+      indices.append(i)
+    else:
+      if start is not None:
+        spans.append(Span(offset=start, size=end - start, indices=tuple(indices)))
+      start, end, indices = offset, offset + size, [i]
+
+  if start is not None:
+    spans.append(Span(offset=start, size=end - start, indices=tuple(indices)))
+
+  return spans
+
+
+_RANGES_WORKERS = int(os.getenv('GFS_RANGES_WORKERS', 16))
+
+_RANGES_EXECUTOR = gns.Var(f'{__name__}.RANGES_EXECUTOR',
+                           fork_init=True,
+                           defval=lambda: xe.Executor(max_threads=_RANGES_WORKERS,
+                                                      name_prefix='GfsRanges'))
+
+def fetch_ranges(fetch_fn, ranges, executor=None):
+  if len(ranges) == 1:
+    return [fetch_fn(*ranges[0])]
+
+  executor = executor or gns.get(_RANGES_EXECUTOR)
+  aresults = [executor.submit_result(fetch_fn, offset, size) for offset, size in ranges]
+
+  return [aresult.wait() for aresult in aresults]
+
+
+_PDL_THRESHOLD = int(os.getenv('GFS_PDL_THRESHOLD', 64 * 1024**2))
+_PDL_PART_SIZE = int(os.getenv('GFS_PDL_PART_SIZE', 16 * 1024**2))
+_PDL_WORKERS = int(os.getenv('GFS_PDL_WORKERS', 8))
+_PDL_RETRIES = int(os.getenv('GFS_PDL_RETRIES', 3))
+
+# Parallel downloads wait for their parts, so they cannot share the common executor
+# with callers which might themselves be running within it.
+_PDL_EXECUTOR = gns.Var(f'{__name__}.PDL_EXECUTOR',
+                        fork_init=True,
+                        defval=lambda: xe.Executor(max_threads=_PDL_WORKERS,
+                                                   name_prefix='GfsDownload'))
+
+def use_parallel_download(size):
+  return size is not None and _PDL_WORKERS > 1 and size >= _PDL_THRESHOLD
+
+
+# Writable file object storing data at increasing offsets of a file descriptor,
+# used to stream fetched data directly into (a region of) a block file.
+class OffsetWriter(io.RawIOBase):
+
+  def __init__(self, fd, offset=0):
+    super().__init__()
+    self._fd = fd
+    self._offset = offset
+
+  def writable(self):
+    return True
+
+  def tell(self):
+    return self._offset
+
+  def write(self, data):
+    mdata = memoryview(data).cast('B')
+    pos = 0
+    while pos < len(mdata):
+      pos += os.pwrite(self._fd, mdata[pos:], self._offset + pos)
+
+    self._offset += pos
+
+    return pos
+
+
+def _retry_part(part_fn, offset, size):
+  for i in range(_PDL_RETRIES + 1):
+    try:
+      return part_fn(offset, size)
+    except Exception as ex:
+      if i >= _PDL_RETRIES:
+        raise
+
+      alog.debug(f'Retrying part fetch at offset {offset} ({size} bytes): {ex}')
+      time.sleep(0.5 * 2**i)
+
+
+def _fetch_part(fetch_fn, fd, offset, size):
+  data = fetch_fn(offset, size)
+  tas.check_eq(len(data), size, msg=f'Short read at offset {offset}')
+
+  os.pwrite(fd, data, offset)
+
+
+def _stream_part(stream_fn, fd, offset, size):
+  writer = OffsetWriter(fd, offset)
+  stream_fn(offset, size, writer)
+  tas.check_eq(writer.tell() - offset, size, msg=f'Short read at offset {offset}')
+
+
+def parallel_download(path, size, fetch_fn, part_size=None, workers=None,
+                      executor=None, stream_fn=None):
+  # Fetches the whole content of an object with concurrent range reads, which get
+  # written at their own offset within a preallocated file. The data goes into a
+  # temporary file which is moved into path once complete, since concurrent
+  # readers of path might expect the data to be appended sequentially.
+  # If stream_fn is specified, it is called as stream_fn(offset, size, fobj) and
+  # must write the range data into fobj, instead of returning it like fetch_fn.
+  part_size = part_size or _PDL_PART_SIZE
+  workers = workers or _PDL_WORKERS
+  executor = executor or gns.get(_PDL_EXECUTOR)
+
+  offsets = iter(range(0, size, part_size))
+  lock = threading.Lock()
+  failed = threading.Event()
+
+  def download(fd):
+    if stream_fn is not None:
+      part_fn = functools.partial(_stream_part, stream_fn, fd)
+    else:
+      part_fn = functools.partial(_fetch_part, fetch_fn, fd)
+
+    while not failed.is_set():
+      with lock:
+        offset = next(offsets, None)
+      if offset is None:
+        break
+
+      try:
+        _retry_part(part_fn, offset, min(part_size, size - offset))
+      except:
+        failed.set()
+        raise
+
+  tpath = fsu.temp_path(nspath=path)
+  try:
+    with osfd.OsFd(tpath, os.O_CREAT | os.O_TRUNC | os.O_WRONLY, mode=0o440) as wfd:
+      if size > 0:
+        if hasattr(os, 'posix_fallocate'):
+          os.posix_fallocate(wfd, 0, size)
+        else:
+          os.ftruncate(wfd, size)
+
+      nworkers = min(workers, (size + part_size - 1) // part_size)
+      aresults = [executor.submit_result(download, wfd) for _ in range(nworkers)]
+
+      # All the workers must be done before the file descriptor gets closed.
+      errors = []
+      for aresult in aresults:
+        try:
+          aresult.wait()
+        except Exception as ex:
+          errors.append(ex)
+
+      if errors:
+        raise errors[0]
+
+    os.replace(tpath, path)
+  except:
+    fsu.maybe_remove(tpath)
+    raise
+
+  return size
+
+
+# Observed fetch throughput (bytes/second) by URL location, used as hint by the
+# block size selection policy.
+_THROUGHPUT = dict()
+_THROUGHPUT_ALPHA = 0.25
+_THROUGHPUT_MINSIZE = 256 * 1024
+
+def _throughput_key(url):
+  return uparse.urlparse(url).netloc if url else None
+
+
+def _update_throughput(url, size, elapsed):
+  if size >= _THROUGHPUT_MINSIZE and elapsed > 0:
+    key = _throughput_key(url)
+    rate = size / elapsed
+    if (xrate := _THROUGHPUT.get(key)) is not None:
+      rate = _THROUGHPUT_ALPHA * rate + (1 - _THROUGHPUT_ALPHA) * xrate
+
+    _THROUGHPUT[key] = rate
+
+
+def get_throughput(url):
+  return _THROUGHPUT.get(_throughput_key(url))
+
+
+def _bitmap_test(bitmap, i):
+  return (bitmap[i >> 3] & (1 << (i & 7))) != 0
+
+
+def _bitmap_set(bitmap, i):
+  bitmap[i >> 3] |= 1 << (i & 7)
+
+
+def _missing_runs(bitmap, first, last):
+  runs, start = [], None
+  for i in range(first, last + 1):
+    if not _bitmap_test(bitmap, i):
+      if start is None:
+        start = i
+    elif start is not None:
+      runs.append((start, i))
+      start = None
+
+  if start is not None:
+    runs.append((start, last + 1))
+
+  return runs
+
+
 class CachedBlockFile:
 
   METAFILE = 'META'
   BLOCKSDIR = 'blocks'
   LINKSDIR = 'links'
+  CASDIR = '.cas'
+  CAS = int(os.getenv('GFS_CACHE_CAS', 0))
   WHOLE_OFFSET = -1
   CID_SIZE = 16
   BLOCKSIZE = 32 * 1024**2
+  MIN_BLOCKSIZE = int(os.getenv('GFS_MIN_BLOCKSIZE', 4 * 1024**2))
+  MAX_BLOCKSIZE = int(os.getenv('GFS_MAX_BLOCKSIZE', 256 * 1024**2))
+  MAX_BLOCKS = int(os.getenv('GFS_MAX_BLOCKS', 4096))
+  BLOCK_FETCH_TIME = float(os.getenv('GFS_BLOCK_FETCH_TIME', 1.0))
+  PAGE_SIZE = 4096
+  SPARSE_PAGESIZE = int(os.getenv('GFS_SPARSE_PAGESIZE', 64 * 1024))
+  SPARSE_EXT = '.sparse'
+  SPARSE_MAP_EXT = '.map'
+  PART_EXT = '.part'
+  ZPART_EXT = '.zpart'
+  COMPRESS = os.getenv('GFS_CACHE_COMPRESS', '')
+  COMPRESS_RATIO = float(os.getenv('GFS_CACHE_COMPRESS_RATIO', 0.8))
+  STREAM_POLL = float(os.getenv('GFS_STREAM_POLL', 0.02))
 
   def __init__(self, path, reader, meta=None, close_fn=None):
     self._path = path
@@ -48,14 +361,49 @@ class CachedBlockFile:
     return Meta(url=None, size=None, block_size=cls.BLOCKSIZE)
 
   @classmethod
-  def prepare_meta(cls, meta, **kwargs):
+  def select_block_size(cls, size, support_blocks, throughput=None):
+    if size is None or not support_blocks:
+      return cls.BLOCKSIZE
+
+    # Aim at blocks which take about BLOCK_FETCH_TIME seconds to fetch (if we have
+    # a throughput hint), while not splitting huge objects in too many blocks.
+    block_size = cls.BLOCKSIZE if throughput is None else throughput * cls.BLOCK_FETCH_TIME
+    block_size = max(block_size, size / cls.MAX_BLOCKS)
+    block_size = min(max(block_size, cls.MIN_BLOCKSIZE), cls.MAX_BLOCKSIZE)
+    block_size = 1 << (int(block_size) - 1).bit_length()
+
+    # Small objects are fetched with a single block read sized after the object.
+    if size <= block_size:
+      block_size = max(cls.PAGE_SIZE, 1 << (max(size, 1) - 1).bit_length())
+
+    return block_size
+
+  @classmethod
+  def prepare_meta(cls, meta, reader=None, **kwargs):
     cmeta = cls.default_meta()
     cmeta.update_from(meta)
     cmeta.update(**kwargs)
 
+    if reader is not None:
+      # Recording whether the reader supports blocks (and ranges) allows opening from
+      # the META without having to create a reader (see CacheInterface.open_url()).
+      cmeta.update(blocks=reader.support_blocks(),
+                   ranges=reader.support_blocks() and hasattr(reader, 'read_ranges'))
+      if getattr(meta, 'block_size', None) is None:
+        block_size = cls.select_block_size(cmeta.size, cmeta.blocks,
+                                           throughput=get_throughput(cmeta.url))
+        cmeta.update(block_size=block_size)
+
     cid = hashlib.sha1(cmeta.tag.encode()).hexdigest()[: cls.CID_SIZE]
     cmeta.update(cid=cid)
 
+    # Only content digests can be used to share blocks among different URLs. Tags
+    # and ETags are not enough, as they can be synthesized from size and modification
+    # time (like many HTTP servers do), and collide among different hosts.
+    if (digest := getattr(cmeta, 'digest', None)) is not None:
+      ckey = hashlib.sha1(f'md5:{digest}:{cmeta.size}'.encode()).hexdigest()
+      cmeta.update(ckey=ckey)
+
     return cmeta
 
   @classmethod
@@ -85,25 +433,237 @@ class CachedBlockFile:
   def _fblock_path(self, offset):
     return self.fblock_path(self._path, self.meta.cid, offset)
 
+  def _cas_path(self, offset):
+    ckey = getattr(self.meta, 'ckey', None)
+    if self.CAS and ckey is not None:
+      # Block offsets only make sense together with the block size.
+      block_id = f'{ckey}-{self.meta.block_size}-{offset}' if offset >= 0 else ckey
+
+      return os.path.join(self.cas_dir(os.path.dirname(self._path)), ckey[: 2], block_id)
+
+  def _cas_load(self, offset, bpath):
+    # Must be called with the block lock held.
+    if (cpath := self._cas_path(offset)) is not None:
+      try:
+        os.link(cpath, bpath)
+
+        return os.stat(bpath).st_size
+      except FileNotFoundError:
+        pass
+      except OSError as ex:
+        alog.debug(f'Unable to link CAS block {cpath} to {bpath}: {ex}')
+
+  def _cas_store(self, offset, bpath):
+    if (cpath := self._cas_path(offset)) is not None:
+      try:
+        os.makedirs(os.path.dirname(cpath), exist_ok=True)
+        os.link(bpath, cpath)
+      except FileExistsError:
+        pass
+      except OSError as ex:
+        alog.debug(f'Unable to link block {bpath} into CAS {cpath}: {ex}')
+
   def _fetch_block(self, offset):
     bpath = self._fblock_path(offset)
-    with lockf.LockFile(bpath):
+    with lockf.create_lock(bpath):
       if (sres := fsu.stat(bpath)) is None:
-        tpath = fsu.temp_path(nspath=bpath)
-        try:
-          rsize = self._reader.read_block(tpath, offset, self.meta.block_size)
-          if rsize > 0:
-            os.replace(tpath, bpath)
-            if offset == self.WHOLE_OFFSET:
-              self._make_link(bpath)
-        except:
+        if (rsize := self._cas_load(offset, bpath)) is None:
+          # The download goes into a well known path (we are holding the block lock)
+          # so that other readers can stream the data while it arrives.
+          tpath = bpath + self.PART_EXT
+          # A part file left by a dead downloader might still be mapped by readers,
+          # which would fault if its inode got truncated by the new download.
           fsu.maybe_remove(tpath)
-          raise
+          try:
+            start = time.time()
+            rsize = self._reader.read_block(tpath, offset, self.meta.block_size)
+            _update_throughput(self.meta.url, rsize, time.time() - start)
+            if rsize > 0:
+              rsize = self._store_block(offset, tpath, bpath)
+              self._cas_store(offset, bpath)
+          except:
+            fsu.maybe_remove(tpath)
+            raise
+
+        if rsize > 0:
+          _note_cache_use(self._path, size=rsize)
+          if offset == self.WHOLE_OFFSET:
+            self._make_link(bpath)
+          else:
+            self._drop_sparse(bpath)
       else:
         rsize = sres.st_size
 
     return rsize, bpath
 
+  def _select_compression(self, tpath):
+    try:
+      codec = bcomp.get_codec(self.COMPRESS)
+    except ValueError as ex:
+      alog.warning(f'Storing {self.meta.url} blocks uncompressed: {ex}')
+      codec = None
+
+    if codec is not None:
+      ratio = bcomp.sample_ratio(codec, mm.file_view(tpath))
+      compress = codec.name if ratio <= self.COMPRESS_RATIO else ''
+
+      alog.debug(f'Sampled {codec.name} compression ratio for {self.meta.url} is {ratio:.2f}')
+    else:
+      compress = ''
+
+    # The decision is recorded within the META, and the first one wins.
+    with lockf.create_lock(self._path):
+      xmeta = self.validate(self._path)
+      if xmeta is not None and xmeta.cid == self.meta.cid:
+        if (xcompress := getattr(xmeta, 'compress', None)) is None:
+          self.save_meta(self._path, xmeta.update(compress=compress))
+        else:
+          compress = xcompress
+
+    self.meta.update(compress=compress)
+
+    return compress
+
+  def _block_compression(self, offset, tpath):
+    # Whole content blocks are linked as local files, so they cannot be compressed.
+    # Same for objects of unknown size, as the block length would not be known.
+    if not self.COMPRESS or offset == self.WHOLE_OFFSET or self.meta.size is None:
+      return ''
+
+    compress = getattr(self.meta, 'compress', None)
+
+    return self._select_compression(tpath) if compress is None else compress
+
+  def _store_block(self, offset, tpath, bpath):
+    # Must be called with the block lock held. The compressed data is written into
+    # a different file, as streaming readers might still be accessing the part file.
+    if compress := self._block_compression(offset, tpath):
+      data = mm.file_view(tpath)
+      zdata = bcomp.encode(bcomp.get_codec(compress), data)
+      if len(zdata) < len(data):
+        zpath = bpath + self.ZPART_EXT
+        try:
+          with open(zpath, mode='wb') as fd:
+            fd.write(zdata)
+
+          os.replace(zpath, bpath)
+        except:
+          fsu.maybe_remove(zpath)
+          raise
+
+        fsu.maybe_remove(tpath)
+
+        return len(zdata)
+
+    os.replace(tpath, bpath)
+
+    return os.path.getsize(bpath)
+
+  def _block_view(self, bpath, boffset):
+    try:
+      view = mm.file_view(bpath)
+    except ValueError:
+      # Empty files cannot be mapped.
+      return memoryview(b'')
+
+    # Compressed blocks are self describing, so the decision does not depend on the
+    # META (blocks linked from the CAS might come from an entry which compressed them).
+    if boffset != self.WHOLE_OFFSET and self.meta.size is not None:
+      block_length = min(self.meta.block_size, self.meta.size - boffset)
+      if bcomp.is_encoded(view, block_length):
+        view = memoryview(bcomp.decode(view))
+
+    return view
+
+  def _sparse_paths(self, bpath):
+    return bpath + self.SPARSE_EXT, bpath + self.SPARSE_MAP_EXT
+
+  def _drop_sparse(self, bpath):
+    for path in self._sparse_paths(bpath):
+      nox.qno_except(fsu.maybe_remove, path)
+
+  def _load_bitmap(self, spath, mpath, block_length, npages):
+    if os.path.exists(spath) and os.path.exists(mpath):
+      bitmap = bytearray(fsu.readall(mpath))
+      if len(bitmap) == (npages + 7) // 8:
+        return bitmap
+
+    # Either first use, or inconsistent state (data file without bitmap, or the
+    # other way around) which is handled by restarting from an empty block.
+    # The data file is filled in place, so it is made read-only only when promoted
+    # to block file.
+    with osfd.OsFd(spath, os.O_CREAT | os.O_TRUNC | os.O_WRONLY, mode=0o640) as fd:
+      os.ftruncate(fd, block_length)
+
+    return bytearray((npages + 7) // 8)
+
+  def _fill_sparse(self, spath, boffset, block_length, bitmap, runs):
+    page_size = self.SPARSE_PAGESIZE
+    ranges = []
+    for start, end in runs:
+      rstart = start * page_size
+      ranges.append((boffset + rstart, min(end * page_size, block_length) - rstart))
+
+    datas = self._reader.read_ranges(ranges)
+    _note_cache_use(self._path, size=sum(rsize for _, rsize in ranges))
+
+    with osfd.OsFd(spath, os.O_WRONLY) as fd:
+      for (roffset, rsize), data in zip(ranges, datas):
+        tas.check_eq(len(data), rsize,
+                     msg=f'Short range read at {roffset} from {self.meta.url}')
+        os.pwrite(fd, data, roffset - boffset)
+
+    for start, end in runs:
+      for i in range(start, end):
+        _bitmap_set(bitmap, i)
+
+  def read_sparse(self, offset, size):
+    # Reads a range contained within a single block, fetching only the (page aligned)
+    # parts of the block which are not already present within the sparse block file.
+    # The data file is paired with a bitmap of the valid pages, and it is promoted
+    # to a full block file once all the pages have been filled.
+    block_size = self.meta.block_size
+    boffset = (offset // block_size) * block_size
+    tas.check_le(offset + size, boffset + block_size,
+                 msg=f'Sparse read crossing block boundary: {offset} + {size}')
+
+    bpath = self._fblock_path(boffset)
+    spath, mpath = self._sparse_paths(bpath)
+    block_length = min(block_size, self.meta.size - boffset)
+    with lockf.create_lock(bpath):
+      if not os.path.exists(bpath) and self._cas_load(boffset, bpath) is not None:
+        self._drop_sparse(bpath)
+      if not os.path.exists(bpath):
+        page_size = self.SPARSE_PAGESIZE
+        npages = (block_length + page_size - 1) // page_size
+
+        bitmap = self._load_bitmap(spath, mpath, block_length, npages)
+        runs = _missing_runs(bitmap,
+                             (offset - boffset) // page_size,
+                             (offset - boffset + size - 1) // page_size)
+        if runs:
+          self._fill_sparse(spath, boffset, block_length, bitmap, runs)
+
+          if not _missing_runs(bitmap, 0, npages - 1):
+            os.chmod(spath, 0o440)
+            os.replace(spath, bpath)
+            fsu.maybe_remove(mpath)
+            self._cas_store(boffset, bpath)
+          else:
+            with osfd.OsFd(mpath, os.O_CREAT | os.O_WRONLY, mode=0o640) as fd:
+              os.pwrite(fd, bitmap, 0)
+
+      if os.path.exists(bpath):
+        view = self._block_view(bpath, boffset)
+      else:
+        view = mm.file_view(spath)
+
+    return view[offset - boffset: offset - boffset + size]
+
+  def support_sparse(self):
+    return (self.meta.size is not None and self.support_ranges() and
+            not os.path.exists(self._fblock_path(self.WHOLE_OFFSET)))
+
   def _make_link(self, bpath):
     lpath = self.local_link()
     if not os.path.exists(lpath):
@@ -117,15 +677,39 @@ class CachedBlockFile:
   def _try_block(self, boffset, offset):
     bpath = self._fblock_path(boffset)
     try:
-      with osfd.OsFd(bpath, os.O_RDONLY) as fd:
-        sres = os.stat(fd)
-        if sres.st_size >= offset:
-          os.lseek(fd, offset, os.SEEK_SET)
-          size = min(self.meta.block_size, sres.st_size - offset)
-
-          return os.read(fd, size)
+      view = self._block_view(bpath, boffset)
     except FileNotFoundError:
-      pass
+      return
+
+    # The returned view keeps the file mapping alive, and reads are served straight
+    # from the page cache, without copies (unless the block is compressed).
+    if len(view) >= offset:
+      return view[offset: offset + self.meta.block_size]
+
+  def _try_partial(self, boffset, offset, min_size):
+    # If another process (or thread) is downloading the block, wait for the data
+    # to be available within the partially written block file, and return a view
+    # over it. If no download is in progress, or the download completed, returns
+    # None and the caller will go through the standard (locked) fetch path.
+    bpath = self._fblock_path(boffset)
+    ppath = bpath + self.PART_EXT
+    lock = lockf.create_lock(bpath)
+    while True:
+      if lock.acquire(timeout=0):
+        lock.release()
+        break
+
+      try:
+        view = mm.file_view(ppath)
+      except (FileNotFoundError, ValueError):
+        # The downloader might not have created the part file yet (ie, waiting for
+        # the first byte), so keep polling until the block lock is released.
+        view = memoryview(b'')
+
+      if len(view) >= offset + min_size:
+        return view[offset: offset + self.meta.block_size]
+
+      time.sleep(self.STREAM_POLL)
 
   def _translate_offset(self, offset):
     has_whole_content = True
@@ -147,23 +731,72 @@ class CachedBlockFile:
       self._close_fn()
       self._close_fn = None
 
+  def prefetch_block(self, offset):
+    boffset, _ = self._translate_offset(offset)
+    if boffset != self.WHOLE_OFFSET and not os.path.exists(self._fblock_path(boffset)):
+      self._fetch_block(boffset)
+
+  def is_cached(self, offset, size):
+    if os.path.exists(self._fblock_path(self.WHOLE_OFFSET)):
+      return True
+    if not self._reader.support_blocks():
+      return False
+
+    lru, block_size = _block_lru(), self.meta.block_size
+    for boffset in range((offset // block_size) * block_size, offset + size, block_size):
+      bpath = self._fblock_path(boffset)
+      if not (lru.contains((bpath, 0, block_size)) or os.path.exists(bpath)):
+        return False
+
+    return True
+
+  def support_ranges(self):
+    if (ranges := getattr(self.meta, 'ranges', None)) is not None:
+      return ranges
+
+    return self._reader.support_blocks() and hasattr(self._reader, 'read_ranges')
+
+  def read_ranges(self, ranges):
+    return self._reader.read_ranges(ranges)
+
+  def block_key(self, offset):
+    return self._fblock_path(offset)
+
   def cacheall(self):
     size, bpath = self._fetch_block(self.WHOLE_OFFSET)
 
     return self.local_link() if size > 0 else None
 
-  def read_block(self, offset):
+  def read_block(self, offset, min_size=None):
     tas.check_eq(offset % self.meta.block_size, 0,
                  msg=f'Block offset ({offset}) must be multiple of {self.meta.block_size}')
 
     boffset, offset = self._translate_offset(offset)
 
+    # Blocks are keyed by path (which contains the content ID) and offset, so all
+    # the CachedBlockFile objects sharing the same cache entry will share the
+    # in-memory copies as well. The block size is part of the key since a dropped
+    # cache entry can be re-created (same path) with a different block size.
+    lru = _block_lru()
+    key = (self._fblock_path(boffset), offset, self.meta.block_size)
+    if (data := lru.get(key)) is not None:
+      return data
+
     data = self._try_block(boffset, offset)
+    if data is None and min_size is not None:
+      # Partially downloaded blocks are not complete, so they cannot be stored
+      # within the memory tier.
+      if (data := self._try_partial(boffset, offset, min_size)) is not None:
+        return data
     if data is None:
       read_size, _ = self._fetch_block(boffset)
       if read_size > 0:
         data = self._try_block(boffset, offset)
 
+    if data is not None:
+      data = memoryview(data)
+      lru.put(key, data)
+
     return data
 
   def size(self):
@@ -177,7 +810,13 @@ class CachedBlockFile:
     return size
 
   def locked(self):
-    return lockf.LockFile(self._path)
+    return lockf.create_lock(self._path)
+
+  def support_blocks(self):
+    if (blocks := getattr(self.meta, 'blocks', None)) is not None:
+      return blocks
+
+    return self._reader.support_blocks()
 
   def local_link(self):
     return self.flink_path(self._path, self.meta.cid, self.meta.url)
@@ -190,6 +829,10 @@ class CachedBlockFile:
   def links_dir(cls, path):
     return os.path.join(path, cls.LINKSDIR)
 
+  @classmethod
+  def cas_dir(cls, cache_dir):
+    return os.path.join(cache_dir, cls.CASDIR)
+
   @classmethod
   def fblock_path(cls, path, cid, offset):
     block_id = f'block-{cid}-{offset}' if offset >= 0 else f'block-{cid}'
@@ -198,7 +841,7 @@ class CachedBlockFile:
 
   @classmethod
   def parse_block_file(cls, fname):
-    m = re.match(r'block\-([^\-]+)(\-(\d+))?$', fname)
+    m = re.match(r'block\-([^\-\.]+)(\-(\d+))?(\.\w+)?$', fname)
     if m:
       offset = m.group(3)
       offset = int(offset) if offset is not None else cls.WHOLE_OFFSET
@@ -269,14 +912,74 @@ class CachedBlockFile:
       pass
 
 
+class _Prefetcher:
+
+  def __init__(self, max_workers, max_inflight):
+    self._executor = xe.Executor(max_threads=max_workers, name_prefix='BlockPrefetch')
+    self._max_inflight = max_inflight
+    self._lock = threading.Lock()
+    self._inflight = 0
+    self._pending = dict()
+
+  def _fetch(self, cbf, key, offset, size):
+    try:
+      cbf.prefetch_block(offset)
+    finally:
+      with self._lock:
+        self._inflight -= size
+        self._pending.pop(key, None)
+
+  def submit(self, cbf, offset, size):
+    key = cbf.block_key(offset)
+    with self._lock:
+      if key in self._pending:
+        return True
+      if self._inflight + size > self._max_inflight:
+        return False
+
+      self._inflight += size
+      self._pending[key] = self._executor.submit_result(self._fetch, cbf, key, offset, size)
+
+    return True
+
+  def wait(self, cbf, offset):
+    with self._lock:
+      aresult = self._pending.get(cbf.block_key(offset))
+
+    if aresult is not None:
+      try:
+        aresult.wait()
+      except Exception as ex:
+        alog.debug(f'Prefetch of block {offset} failed, will retry inline: {ex}')
+
+
+_RANGES_MAXGAP = int(os.getenv('GFS_RANGES_MAXGAP', 64 * 1024))
+_SPARSE = int(os.getenv('GFS_SPARSE', 0))
+_SPARSE_MAXREAD = int(os.getenv('GFS_SPARSE_MAXREAD', 4 * 1024**2))
+_READ_AHEAD = int(os.getenv('GFS_READ_AHEAD', 0))
+_READ_AHEAD_WORKERS = int(os.getenv('GFS_READ_AHEAD_WORKERS', 8))
+_READ_AHEAD_MAXBYTES = int(os.getenv('GFS_READ_AHEAD_MAXBYTES', 256 * 1024**2))
+
+_PREFETCHER = gns.Var(f'{__name__}.PREFETCHER',
+                      fork_init=True,
+                      defval=lambda: _Prefetcher(_READ_AHEAD_WORKERS, _READ_AHEAD_MAXBYTES))
+
+def _prefetcher():
+  return gns.get(_PREFETCHER)
+
+
 class CachedFile:
 
-  def __init__(self, cbf, block_size=None):
+  def __init__(self, cbf, block_size=None, read_ahead=None, sparse=None):
     fw.fin_wrap(self, 'cbf', cbf, finfn=cbf.close)
     self._block_size = block_size or cbf.meta.block_size
+    self._read_ahead = _READ_AHEAD if read_ahead is None else read_ahead
+    self._sparse = (_SPARSE if sparse is None else sparse) and cbf.support_sparse()
     self._offset = 0
     self._block_start = 0
     self._block = None
+    self._prefetched = 0
+    self._last_offset = 0
 
   def close(self):
     cbf = self.cbf
@@ -307,14 +1010,47 @@ class CachedFile:
   def tell(self):
     return self._offset
 
+  def _is_sequential(self, block_offset):
+    if self._block is None:
+      return block_offset == 0
+
+    return block_offset == self._block_start + self._block_size
+
+  def _read_ahead_blocks(self, block_offset):
+    # Read-ahead only makes sense if the reader can fetch blocks, and if we know
+    # where the content ends (so that we do not issue fetches past the end).
+    size = self.cbf.meta.size
+    if size is None or not self.cbf.support_blocks():
+      return
+
+    prefetcher = _prefetcher()
+    start = max(block_offset + self._block_size, self._prefetched)
+    end = min(block_offset + (self._read_ahead + 1) * self._block_size, size)
+    for offset in range(start, end, self._block_size):
+      if not prefetcher.submit(self.cbf, offset, min(self._block_size, size - offset)):
+        break
+      self._prefetched = offset + self._block_size
+
   def _ensure_buffer(self, offset):
     boffset = offset - self._block_start
     if self._block is None or boffset < 0 or boffset >= len(self._block):
       block_offset = (offset // self._block_size) * self._block_size
 
-      self._block = memoryview(self.cbf.read_block(block_offset))
+      if self._read_ahead > 0:
+        _prefetcher().wait(self.cbf, block_offset)
+        if self._is_sequential(block_offset):
+          self._read_ahead_blocks(block_offset)
+        else:
+          self._prefetched = 0
+
+      self._block = memoryview(self.cbf.read_block(block_offset,
+                                                   min_size=offset - block_offset + 1))
       self._block_start = block_offset
       boffset = offset - block_offset
+      # Reads are bounded by the content size, so a short block means a corrupted
+      # (or truncated) cache entry, which would otherwise make readers spin.
+      tas.check_lt(boffset, len(self._block),
+                   msg=f'Short block at {block_offset} for {self.cbf.meta.url}')
 
     return boffset
 
@@ -323,8 +1059,29 @@ class CachedFile:
 
     return available if size < 0 else min(size, available)
 
+  def _try_sparse(self, offset, size):
+    # Small random reads are served by only fetching the needed pages of the block,
+    # while sequential ones go through the whole block path.
+    if (size <= _SPARSE_MAXREAD and offset != self._last_offset and
+        (offset % self._block_size) + size <= self._block_size):
+      boffset = offset - self._block_start
+      if self._block is None or boffset < 0 or boffset + size > len(self._block):
+        if not self.cbf.is_cached(offset, size):
+          return self.cbf.read_sparse(offset, size)
+
+  def _sparse_read(self, size):
+    if self._sparse and size > 0:
+      data = self._try_sparse(self._offset, size)
+      if data is not None:
+        self._offset += len(data)
+        self._last_offset = self._offset
+
+        return data
+
   def read(self, size=-1):
     rsize = self._max_size(size)
+    if (data := self._sparse_read(rsize)) is not None:
+      return data.tobytes()
 
     parts = []
     while rsize > 0:
@@ -335,13 +1092,128 @@ class CachedFile:
       self._offset += csize
       rsize -= csize
 
+    self._last_offset = self._offset
+
     return b''.join(parts)
 
   def read1(self, size=-1):
     return self.read(size=size)
 
+  def readinto(self, b):
+    mv = memoryview(b).cast('B')
+    rsize = self._max_size(len(mv))
+    if (data := self._sparse_read(rsize)) is not None:
+      mv[: len(data)] = data
+
+      return len(data)
+
+    pos = 0
+    while pos < rsize:
+      boffset = self._ensure_buffer(self._offset)
+
+      csize = min(rsize - pos, len(self._block) - boffset)
+      mv[pos: pos + csize] = self._block[boffset: boffset + csize]
+      self._offset += csize
+      pos += csize
+
+    self._last_offset = self._offset
+
+    return pos
+
+  def readinto1(self, b):
+    return self.readinto(b)
+
+  def readall(self):
+    return self.read()
+
+  def read_view(self, size=-1):
+    # Returns a buffer-protocol object with the data (ie, usable by np.frombuffer()).
+    # If the requested range lies within a single block, the returned memoryview
+    # points straight into the block mapping, otherwise a single copy is made.
+    rsize = self._max_size(size)
+    if rsize > 0:
+      boffset = self._ensure_buffer(self._offset)
+      if len(self._block) - boffset >= rsize:
+        self._offset += rsize
+        self._last_offset = self._offset
+
+        return self._block[boffset: boffset + rsize]
+
+      data = bytearray(rsize)
+      self.readinto(data)
+
+      return memoryview(data)
+
+    return memoryview(b'')
+
+  def _pread(self, offset, size):
+    parts = []
+    while size > 0:
+      boffset = self._ensure_buffer(offset)
+
+      csize = min(size, len(self._block) - boffset)
+      parts.append(self._block[boffset: boffset + csize])
+      offset += csize
+      size -= csize
+
+    if len(parts) == 1:
+      return parts[0]
+
+    return memoryview(b''.join(parts))
+
+  def pread_ranges(self, ranges, max_gap=None):
+    # Reads the (offset, size) ranges, without moving the file offset, and returns a
+    # list of memoryview objects, one for each range, in the same order.
+    # Nearby ranges are merged into spans, and spans which are not already available
+    # within the local cache are fetched concurrently from the reader (only the
+    # bytes within the span), instead of pulling whole blocks.
+    max_gap = _RANGES_MAXGAP if max_gap is None else max_gap
+    fsize = self.cbf.size()
+
+    cranges = []
+    for offset, size in ranges:
+      tas.check(0 <= offset <= fsize, msg=f'Offset out of range: {offset}')
+      cranges.append((offset, max(0, min(size, fsize - offset))))
+
+    local_spans, remote_spans = [], []
+    for span in coalesce_ranges(cranges, max_gap=max_gap):
+      if not self.cbf.support_ranges() or self.cbf.is_cached(span.offset, span.size):
+        local_spans.append(span)
+      else:
+        remote_spans.append(span)
+
+    results = [None] * len(cranges)
+
+    def assign(span, data):
+      for i in span.indices:
+        offset, size = cranges[i]
+        soffset = offset - span.offset
+        results[i] = data[soffset: soffset + size]
+
+    for span in local_spans:
+      assign(span, self._pread(span.offset, span.size))
+
+    if self._sparse:
+      # Spans contained within a single block are filled into the sparse cache, so
+      # that subsequent reads of the same ranges will not hit the reader again.
+      block_spans = []
+      for span in remote_spans:
+        if (span.offset % self._block_size) + span.size <= self._block_size:
+          assign(span, self.cbf.read_sparse(span.offset, span.size))
+        else:
+          block_spans.append(span)
+
+      remote_spans = block_spans
+
+    if remote_spans:
+      datas = self.cbf.read_ranges([(span.offset, span.size) for span in remote_spans])
+      for span, data in zip(remote_spans, datas):
+        assign(span, memoryview(data))
+
+    return results
+
   def peek(self, size=0):
-    if size > 0:
+    if size > 0 and (size := self._max_size(size)) > 0:
       boffset = self._ensure_buffer(self._offset)
       csize = min(size, len(self._block) - boffset)
 
@@ -391,22 +1263,115 @@ class CachedFile:
     return False
 
 
+class StaleContentError(Exception):
+  pass
+
+
+class _LazyReader:
+
+  # Stands in for the real reader when a file is opened from an existing META.
+  # The real reader (whose creation typically requires a round trip to the server)
+  # is only created once some data needs to be fetched, and its content tag must
+  # match the one of the cached content.
+
+  def __init__(self, url, meta, reader_fn):
+    self._url = url
+    self._meta = meta
+    self._reader_fn = reader_fn
+    self._lock = threading.Lock()
+    self._reader = None
+
+  def _get_reader(self):
+    with self._lock:
+      if self._reader is None:
+        reader, meta = self._reader_fn()
+        if meta.tag != self._meta.tag:
+          alog.xraise(StaleContentError,
+                      f'Content of {self._url} changed since it was cached ' \
+                      f'({self._meta.tag} -> {meta.tag})')
+
+        self._reader = reader
+
+      return self._reader
+
+  def support_blocks(self):
+    return self._meta.blocks
+
+  def __getattr__(self, name):
+    return getattr(self._get_reader(), name)
+
+
+_OPEN_POLICIES = ('strict', 'stale-ok', 'revalidate-async')
+_OPEN_POLICY = os.getenv('GFS_OPEN_CACHE_POLICY', 'strict')
+
 class CacheInterface:
 
   def __init__(self, cache_dir):
     self._cache_dir = cache_dir
 
+  def _update_meta(self, cfpath, url, meta, reader):
+    meta = CachedBlockFile.prepare_meta(meta, reader=reader, url=url)
+    if (xmeta := CachedBlockFile.validate(cfpath)) is None:
+      CachedBlockFile.create(cfpath, meta)
+    elif xmeta.cid == meta.cid:
+      # Blocks already stored for the same content have been fetched with the
+      # block size recorded in the existing META, so it must be kept.
+      meta.update(block_size=getattr(xmeta, 'block_size', CachedBlockFile.BLOCKSIZE))
+      if (compress := getattr(xmeta, 'compress', None)) is not None:
+        meta.update(compress=compress)
+      if getattr(xmeta, 'blocks', None) is None or getattr(xmeta, 'ranges', None) is None:
+        CachedBlockFile.save_meta(cfpath, meta)
+    else:
+      alog.debug(f'Updating meta of {cfpath}: {xmeta} -> {meta}')
+      CachedBlockFile.save_meta(cfpath, meta)
+
+    return meta
+
   def _open(self, cfpath, url, meta, reader, close_fn=None, **kwargs):
-    with lockf.LockFile(cfpath):
-      meta = CachedBlockFile.prepare_meta(meta, url=url)
-      if (xmeta := CachedBlockFile.validate(cfpath)) is None:
-        CachedBlockFile.create(cfpath, meta)
-      else:
-        if xmeta.cid != meta.cid:
-          alog.debug(f'Updating meta of {cfpath}: {xmeta} -> {meta}')
-          CachedBlockFile.save_meta(cfpath, meta)
+    _note_cache_use(cfpath)
+    with lockf.create_lock(cfpath):
+      meta = self._update_meta(cfpath, url, meta, reader)
+
+      return CachedFile(CachedBlockFile(cfpath, reader, meta=meta, close_fn=close_fn),
+                        read_ahead=kwargs.get('read_ahead'),
+                        sparse=kwargs.get('sparse'))
+
+  def _revalidate(self, cfpath, url, reader_fn):
+    reader, meta = reader_fn()
+    with lockf.create_lock(cfpath):
+      self._update_meta(cfpath, url, meta, reader)
+
+    return reader, meta
+
+  def open_url(self, url, reader_fn, cache_policy=None, **kwargs):
+    # The reader_fn() returns the (reader, meta) tuple for the URL, whose creation
+    # usually involves a round trip to the server. With the "stale-ok" policy an
+    # existing META is trusted without checking with the server (until a block
+    # needs to be fetched), while "revalidate-async" also refreshes the META in
+    # background, so that the next opens will see the new content (if changed).
+    cache_policy = cache_policy or _OPEN_POLICY
+    tas.check(cache_policy in _OPEN_POLICIES, msg=f'Invalid cache policy: {cache_policy}')
+
+    if cache_policy != 'strict' and not kwargs.get('uncached', False):
+      cfpath = _get_cache_path(self._cache_dir, url)
+      xmeta = CachedBlockFile.validate(cfpath)
+      if (xmeta is not None and getattr(xmeta, 'blocks', None) is not None and
+          getattr(xmeta, 'ranges', None) is not None):
+        if cache_policy == 'revalidate-async':
+          aresult = xe.common_executor().submit_result(self._revalidate, cfpath, url,
+                                                       reader_fn)
+          reader_fn = aresult.wait
+
+        _note_cache_use(cfpath)
+
+        return CachedFile(CachedBlockFile(cfpath, _LazyReader(url, xmeta, reader_fn),
+                                          meta=xmeta),
+                          read_ahead=kwargs.get('read_ahead'),
+                          sparse=kwargs.get('sparse'))
+
+    reader, meta = reader_fn()
 
-      return CachedFile(CachedBlockFile(cfpath, reader, meta=meta, close_fn=close_fn))
+    return self.open(url, meta, reader, **kwargs)
 
   def open(self, url, meta, reader, **kwargs):
     uncached = kwargs.pop('uncached', False)
@@ -439,16 +1404,15 @@ _CacheFileStats = collections.namedtuple(
   'CacheFileStats', 'path, mtime, size, meta',
 )
 
-def cleanup_cache(cache_dir, max_age=None, max_size=None):
-  alog.verbose(f'Cache cleanup running: {cache_dir}')
-
+def _scan_cache(cache_dir, max_age=None):
+  cache_files = []
   if os.path.isdir(cache_dir):
-    cache_files = []
     with os.scandir(cache_dir) as sdit:
       for dentry in sdit:
-        if dentry.is_dir():
-          cfpath = os.path.join(cache_dir, dentry.name)
-          with lockf.LockFile(cfpath):
+        cfpath = os.path.join(cache_dir, dentry.name)
+        # Skip entries which are still being created (no META file yet).
+        if dentry.is_dir() and os.path.exists(CachedBlockFile.fmeta_path(cfpath)):
+          with lockf.create_lock(cfpath):
             try:
               meta = CachedBlockFile.purge_blocks(cfpath, max_age=max_age)
 
@@ -461,20 +1425,58 @@ def cleanup_cache(cache_dir, max_age=None, max_size=None):
             except Exception as ex:
               alog.warning(f'Unable to purge blocks from {cfpath}: {ex}')
 
+  return cache_files
+
+
+def _cleanup_cas(cache_dir):
+  # Content addressed blocks which are not linked by any cache entry anymore
+  # (link count dropped to one) are removed.
+  cas_dir = CachedBlockFile.cas_dir(cache_dir)
+  dropped = 0
+  if os.path.isdir(cas_dir):
+    for root, dirs, files in os.walk(cas_dir):
+      for fname in files:
+        path = os.path.join(root, fname)
+        try:
+          sres = os.stat(path)
+          if sres.st_nlink <= 1:
+            os.remove(path)
+            dropped += sres.st_size
+        except FileNotFoundError:
+          pass
+
+  if dropped:
+    alog.debug0(f'Dropped {cu.size_str(dropped)} of unreferenced CAS blocks from {cas_dir}')
+
+  return dropped
+
+
+def _drop_cache_entry(path):
+  with lockf.create_lock(path):
+    return CachedBlockFile.remove(path)
+
+
+def cleanup_cache(cache_dir, max_age=None, max_size=None):
+  alog.verbose(f'Cache cleanup running: {cache_dir}')
+
+  if os.path.isdir(cache_dir):
+    cache_files = _scan_cache(cache_dir, max_age=max_age)
+
     cache_files = sorted(cache_files, key=lambda cfs: cfs.mtime, reverse=True)
-    max_size = max_size or int(os.getenv('GFS_CACHE_MAXSIZE', 16 * 1024**3))
+    max_size = max_size or _CACHE_MAXSIZE
 
     cache_size = 0
     for cfs in cache_files:
       cache_size += cfs.size
       if cache_size >= max_size:
         alog.info(f'Dropping cache for {cfs.meta.url} stored at {cfs.path}')
-        with lockf.LockFile(cfs.path):
-          CachedBlockFile.remove(cfs.path)
+        _drop_cache_entry(cfs.path)
 
     alog.debug0(f'Cache size was {cu.size_str(cache_size)} (size will be trimmed ' \
                 f'to {cu.size_str(max_size)})')
 
+    _cleanup_cas(cache_dir)
+
 
 def make_tag(**kwargs):
   stag = ','.join(f'{k}={v}' for k, v in kwargs.items())
@@ -482,26 +1484,176 @@ def make_tag(**kwargs):
   return hashlib.sha1(stag.encode()).hexdigest()
 
 
+_CACHE_MAXSIZE = int(os.getenv('GFS_CACHE_MAXSIZE', 16 * 1024**3))
+_CACHE_LOWMARK = float(os.getenv('GFS_CACHE_LOWMARK', 0.8))
+_CACHE_POLICY = os.getenv('GFS_CACHE_POLICY', 'lru')
 _CLEANUP_PERIOD = int(os.getenv('GFS_CACHE_CLEANUP_PERIOD', 8 * 3600))
+_EVICT_PERIOD = int(os.getenv('GFS_CACHE_EVICT_PERIOD', 60))
+_EVICT_GRACE = int(os.getenv('GFS_CACHE_EVICT_GRACE', 300))
+
+_EntryStats = collections.namedtuple('EntryStats', 'size, atime, hits')
+
+class CacheEvictor:
+
+  # Keeps an in-memory index of the cache entries (size, last access time and
+  # number of accesses) which is incrementally updated by the cache users, and
+  # runs evictions from a background thread when the cache size goes over the
+  # high watermark (max_size), down to the low watermark (low_mark * max_size).
+  # The full cache directory scan (which also purges stale blocks) only happens
+  # within the background thread, at most every GFS_CACHE_CLEANUP_PERIOD seconds
+  # across all the processes sharing the cache (as tracked by the mtime of the
+  # .last_cleanup file).
 
-def _cleanup_check(path):
-  lpath = os.path.join(path, '.last_cleanup')
-  if (sres := fsu.stat(lpath)) is None:
-    do_cleanup = os.path.isdir(path)
-  else:
-    do_cleanup = time.time() > sres.st_mtime + _CLEANUP_PERIOD
+  def __init__(self, cache_dir, max_size=None, low_mark=None, policy=None,
+               period=None, grace=None):
+    self._cache_dir = cache_dir
+    self._max_size = max_size or _CACHE_MAXSIZE
+    self._low_size = int(self._max_size * (low_mark or _CACHE_LOWMARK))
+    self._policy = policy or _CACHE_POLICY
+    self._period = period or _EVICT_PERIOD
+    self._grace = _EVICT_GRACE if grace is None else grace
+    self._lock = threading.Lock()
+    self._entries = dict()
+    self._size = 0
+    self._next_scan = self._scan_time()
+    self._wakeup = threading.Event()
+    self._thread = threading.Thread(target=self._run,
+                                    name=f'CacheEvictor-{cache_dir}',
+                                    daemon=True)
+    self._thread.start()
+
+  def note(self, path, size=0):
+    with self._lock:
+      entry = self._entries.get(path)
+      if entry is None:
+        entry = _EntryStats(size=size, atime=time.time(), hits=1)
+      else:
+        entry = entry._replace(size=entry.size + size,
+                               atime=time.time(),
+                               hits=entry.hits + 1)
+
+      self._entries[path] = entry
+      self._size += size
+      if self._size > self._max_size:
+        self._wakeup.set()
+
+  def size(self):
+    with self._lock:
+      return self._size
+
+  def _lastscan_path(self):
+    return os.path.join(self._cache_dir, '.last_cleanup')
+
+  def _scan_time(self):
+    sres = fsu.stat(self._lastscan_path())
+
+    return sres.st_mtime + _CLEANUP_PERIOD if sres is not None else 0
+
+  def _scan(self):
+    alog.verbose(f'Cache scan running: {self._cache_dir}')
+
+    cache_files = _scan_cache(self._cache_dir)
+    _cleanup_cas(self._cache_dir)
+
+    with self._lock:
+      entries, size = dict(), 0
+      for cfs in cache_files:
+        entry = self._entries.get(cfs.path)
+        if entry is None:
+          entry = _EntryStats(size=cfs.size, atime=cfs.mtime, hits=0)
+        else:
+          entry = entry._replace(size=cfs.size, atime=max(cfs.mtime, entry.atime))
+
+        entries[cfs.path] = entry
+        size += cfs.size
+
+      self._entries, self._size = entries, size
+
+    if os.path.isdir(self._cache_dir):
+      with open(self._lastscan_path(), mode='w') as fd:
+        fd.write(datetime.datetime.now().isoformat(timespec='microseconds'))
+
+  def _eviction_key(self, item):
+    path, entry = item
+
+    return (entry.hits, entry.atime) if self._policy == 'lfu' else entry.atime
+
+  def _evict(self):
+    with self._lock:
+      if self._size <= self._max_size:
+        return
 
-  if do_cleanup:
-    alog.debug(f'Triggering cache cleanup: {path}')
-    cleanup_cache(path)
-    with open(lpath, mode='w') as fd:
-      fd.write(datetime.datetime.now().isoformat(timespec='microseconds'))
+      candidates = sorted(self._entries.items(), key=self._eviction_key)
 
-  return path
+    alog.debug0(f'Cache size is {cu.size_str(self._size)}, evicting down to ' \
+                f'{cu.size_str(self._low_size)}')
+    for path, entry in candidates:
+      # Entries which have been recently used are likely to be still open, so they
+      # are not evicted even if that means staying above the watermark.
+      if time.time() - entry.atime < self._grace:
+        continue
+
+      alog.info(f'Dropping cache stored at {path}')
+      _drop_cache_entry(path)
+      with self._lock:
+        if self._entries.pop(path, None) is not None:
+          self._size -= entry.size
+        if self._size <= self._low_size:
+          break
+
+    # Blocks of the dropped entries might be still referenced by the content
+    # addressed store, and they need to go as well.
+    _cleanup_cas(self._cache_dir)
+
+  def _run(self):
+    while True:
+      try:
+        if time.time() >= self._next_scan:
+          # Another process might have scanned the cache in the meantime.
+          self._next_scan = self._scan_time()
+          if time.time() >= self._next_scan:
+            self._scan()
+            self._next_scan = time.time() + _CLEANUP_PERIOD
+
+        self._evict()
+      except Exception as ex:
+        alog.warning(f'Cache eviction failed on {self._cache_dir}: {ex}')
+
+      self._wakeup.wait(timeout=self._period)
+      self._wakeup.clear()
+
+
+class _Evictors:
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._evictors = dict()
+
+  def get(self, cache_dir, create=True):
+    with self._lock:
+      evictor = self._evictors.get(cache_dir)
+      if evictor is None and create:
+        evictor = CacheEvictor(cache_dir)
+        self._evictors[cache_dir] = evictor
+
+      return evictor
+
+
+_EVICTORS = gns.Var(f'{__name__}.EVICTORS',
+                    fork_init=True,
+                    defval=lambda: _Evictors())
+
+def get_evictor(cache_dir, create=True):
+  return gns.get(_EVICTORS).get(cache_dir, create=create)
+
+
+def _note_cache_use(path, size=0):
+  if (evictor := get_evictor(os.path.dirname(path), create=False)) is not None:
+    evictor.note(path, size=size)
 
 
 def get_cache_dir(path):
   cdpath = os.path.join(fsu.normpath(path), 'gfs')
+  get_evictor(cdpath)
 
-  return _cleanup_check(cdpath)
-
+  return cdpath
@@ -1,6 +1,12 @@
 import hashlib
+import mmap
 import os
-import shutil
+import stat as st
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
 
 from .. import alog
 from .. import assert_checks as tas
@@ -10,6 +16,129 @@ from .. import fs_utils as fsu
 from .. import osfd
 
 
+# Cache mode for data copied from/to local files: "fadvise" drops the copied pages
+# from the page cache (POSIX_FADV_DONTNEED), while "direct" reads the source with
+# O_DIRECT (falling back to "fadvise" when not possible).
+_NOCACHE = os.getenv('GFS_FILE_NOCACHE', '')
+_COPY_CHUNK = int(os.getenv('GFS_FILE_COPY_CHUNK', 8 * 1024**2))
+_DIRECT_ALIGN = 4096
+
+
+def _fadvise(fd, offset, size, advice):
+  if hasattr(os, 'posix_fadvise'):
+    try:
+      os.posix_fadvise(fd, offset, size, advice)
+    except OSError:
+      pass
+
+
+def _drop_cache(fd, offset, size):
+  if hasattr(os, 'POSIX_FADV_DONTNEED'):
+    _fadvise(fd, offset, size, os.POSIX_FADV_DONTNEED)
+
+
+def _write_all(fd, data):
+  mdata = memoryview(data).cast('B')
+  pos = 0
+  while pos < len(mdata):
+    pos += os.write(fd, mdata[pos:])
+
+  return pos
+
+
+def _copy_file_range(src_fd, dest_fd, offset, count):
+  return os.copy_file_range(src_fd, dest_fd, count, offset_src=offset)
+
+
+def _sendfile(src_fd, dest_fd, offset, count):
+  return os.sendfile(dest_fd, src_fd, offset, count)
+
+
+def _user_copy(src_fd, dest_fd, offset, count):
+  return _write_all(dest_fd, os.pread(src_fd, count, offset))
+
+
+def _chunked_copy(copy_fn, src_fd, dest_fd, offset, size, drop_cache, fallback):
+  # Returns None if copy_fn is not usable (only detected when nothing has been
+  # copied yet), and fallback is True. Some file systems (like procfs, or some
+  # FUSE ones) report no data for in-kernel copies, instead of failing them.
+  copied = 0
+  while copied < size:
+    try:
+      count = copy_fn(src_fd, dest_fd, offset + copied, min(size - copied, _COPY_CHUNK))
+    except OSError as ex:
+      if copied > 0 or not fallback:
+        raise
+
+      alog.debug(f'Unable to copy data using {copy_fn.__name__}(): {ex}')
+      return
+
+    if count == 0:
+      if copied == 0 and fallback:
+        alog.debug(f'No data copied using {copy_fn.__name__}()')
+        return
+
+      break
+    if drop_cache:
+      _drop_cache(src_fd, offset + copied, count)
+    copied += count
+
+  return copied
+
+
+def _copy_fd(src_fd, dest_fd, offset, size, drop_cache=False):
+  # Copies size bytes at offset of src_fd into dest_fd (at its current position),
+  # in kernel space when possible.
+  for name, copy_fn in (('copy_file_range', _copy_file_range), ('sendfile', _sendfile)):
+    if hasattr(os, name):
+      copied = _chunked_copy(copy_fn, src_fd, dest_fd, offset, size, drop_cache, True)
+      if copied is not None:
+        return copied
+
+  return _chunked_copy(_user_copy, src_fd, dest_fd, offset, size, drop_cache, False)
+
+
+def _direct_copy(src_path, dest_fd, offset, size):
+  try:
+    src_fd = os.open(src_path, os.O_RDONLY | os.O_DIRECT)
+  except OSError as ex:
+    alog.debug(f'Unable to open {src_path} with O_DIRECT: {ex}')
+    return
+
+  # O_DIRECT reads need aligned buffers, which anonymous mmaps are.
+  chunk_size = max(_COPY_CHUNK // _DIRECT_ALIGN, 1) * _DIRECT_ALIGN
+  buffer = mmap.mmap(-1, chunk_size)
+  mbuffer = memoryview(buffer)
+  try:
+    copied = 0
+    while copied < size:
+      count = os.preadv(src_fd, [buffer], offset + copied)
+      if count == 0:
+        break
+      copied += _write_all(dest_fd, mbuffer[: min(count, size - copied)])
+
+    return copied
+  finally:
+    mbuffer.release()
+    buffer.close()
+    os.close(src_fd)
+
+
+def _copy_data(src_path, dest_fd, offset, size, nocache=None):
+  nocache = _NOCACHE if nocache is None else nocache
+  if nocache == 'direct' and hasattr(os, 'O_DIRECT') and offset % _DIRECT_ALIGN == 0:
+    copied = _direct_copy(src_path, dest_fd, offset, size)
+    if copied is not None:
+      return copied
+
+  with osfd.OsFd(src_path, os.O_RDONLY) as src_fd:
+    size = max(min(size, os.fstat(src_fd).st_size - offset), 0)
+    if nocache and hasattr(os, 'POSIX_FADV_SEQUENTIAL'):
+      _fadvise(src_fd, offset, size, os.POSIX_FADV_SEQUENTIAL)
+
+    return _copy_fd(src_fd, dest_fd, offset, size, drop_cache=bool(nocache))
+
+
 class FileReader:
 
   def __init__(self, path):
@@ -23,22 +152,58 @@ class FileReader:
     return True
 
   def read_block(self, bpath, offset, size):
-    if offset != chf.CachedBlockFile.WHOLE_OFFSET:
-      with (osfd.OsFd(self._path, os.O_RDONLY) as rfd,
-            osfd.OsFd(bpath, os.O_CREAT | os.O_TRUNC | os.O_WRONLY, mode=0o440) as wfd):
-        if os.lseek(rfd, offset, os.SEEK_SET) != offset:
-          alog.xraise(RuntimeError, f'Unable to seek {self._path} at offset {offset}')
-        data = os.read(rfd, size)
-        os.write(wfd, data)
+    # Block files are not preallocated, as readers waiting on a block being fetched
+    # rely on its size to know how much data is available.
+    if offset == chf.CachedBlockFile.WHOLE_OFFSET:
+      offset, size = 0, os.path.getsize(self._path)
+
+    with osfd.OsFd(bpath, os.O_CREAT | os.O_TRUNC | os.O_WRONLY, mode=0o440) as wfd:
+      return _copy_data(self._path, wfd, offset, size)
+
 
-        return len(data)
-    else:
-      with open(self._path, mode='rb') as rfd:
-        bfd = os.open(bpath, os.O_CREAT | os.O_TRUNC | os.O_WRONLY, mode=0o440)
-        with open(bfd, mode='wb') as wfd:
-          shutil.copyfileobj(rfd, wfd)
+# From linux/fs.h, clones the source file extents into the destination file.
+_FICLONE = 0x40049409
 
-      return os.path.getsize(bpath)
+def _reflink(src_fd, dest_fd):
+  if fcntl is not None:
+    try:
+      fcntl.ioctl(dest_fd, _FICLONE, src_fd)
+
+      return True
+    except OSError:
+      pass
+
+  return False
+
+
+def _preallocate(fd, size):
+  if size > 0 and hasattr(os, 'posix_fallocate'):
+    try:
+      os.posix_fallocate(fd, 0, size)
+    except OSError as ex:
+      alog.debug(f'Unable to preallocate {size} bytes: {ex}')
+
+
+def copy_file(src_path, dest_path, nocache=None):
+  # Tries to clone the file first (only works on file systems with reflink support,
+  # like XFS or btrfs), then falls back to in-kernel copies into a preallocated
+  # destination.
+  nocache = _NOCACHE if nocache is None else nocache
+  with (osfd.OsFd(src_path, os.O_RDONLY) as src_fd,
+        osfd.OsFd(dest_path, os.O_CREAT | os.O_TRUNC | os.O_WRONLY, mode=0o666) as dest_fd):
+    if _reflink(src_fd, dest_fd):
+      return
+
+    size = os.fstat(src_fd).st_size
+    _preallocate(dest_fd, size)
+
+    copied = _copy_data(src_path, dest_fd, 0, size, nocache=nocache)
+    tas.check_eq(copied, size, msg=f'Short copy from {src_path} to {dest_path}')
+
+    if nocache:
+      # Dirty pages cannot be dropped, so they need to be written back first.
+      os.fdatasync(dest_fd)
+      _drop_cache(dest_fd, 0, 0)
 
 
 class FileFs(fsb.FsBase):
@@ -90,23 +255,51 @@ class FileFs(fsb.FsBase):
   def rmtree(self, url, ignore_errors=None):
     fsu.safe_rmtree(url, ignore_errors=ignore_errors or False)
 
-  def list(self, url):
+  def list(self, url, with_stats=True):
     with os.scandir(url) as sdit:
       for de in sdit:
-        sres = de.stat()
-
-        yield fsb.DirEntry(name=de.name,
-                           path=os.path.join(url, de.name),
-                           etag=self._create_tag(sres),
-                           st_mode=sres.st_mode,
-                           st_size=sres.st_size,
-                           st_ctime=sres.st_ctime,
-                           st_mtime=sres.st_mtime)
+        if with_stats:
+          sres = de.stat()
+
+          yield fsb.DirEntry(name=de.name,
+                             path=os.path.join(url, de.name),
+                             etag=self._create_tag(sres),
+                             st_mode=sres.st_mode,
+                             st_size=sres.st_size,
+                             st_ctime=sres.st_ctime,
+                             st_mtime=sres.st_mtime)
+        else:
+          # The entry type comes for free from the directory listing on most
+          # platforms, while the other stat fields require a system call.
+          yield fsb.DirEntry(name=de.name,
+                             path=os.path.join(url, de.name),
+                             st_mode=st.S_IFDIR if de.is_dir() else st.S_IFREG,
+                             st_size=None,
+                             st_ctime=None,
+                             st_mtime=None)
+
+  def _is_walk_dir(self, url, de):
+    # Like os.walk(), symlinks to directories are not followed.
+    return super()._is_walk_dir(url, de) and not os.path.islink(de.path)
+
+  def server_copy(self, url, dest_fs, dest_url):
+    if isinstance(dest_fs, FileFs):
+      copy_file(url, dest_url)
+
+      return True
+
+    return False
 
   def put_file(self, url, data_gen):
-    with open(url, mode='wb') as fd:
+    # Data is written straight to the file descriptor, without going through the
+    # (copying) Python file buffering.
+    with osfd.OsFd(url, os.O_CREAT | os.O_TRUNC | os.O_WRONLY, mode=0o666) as fd:
       for data in data_gen:
-        fd.write(data)
+        _write_all(fd, data)
+
+      if _NOCACHE:
+        os.fdatasync(fd)
+        _drop_cache(fd, 0, 0)
 
   def get_file(self, url):
     with open(url, mode='rb') as fd:
@@ -4,6 +4,7 @@ import hashlib
 import io
 import os
 import tempfile
+import threading
 import urllib.parse as uparse
 
 import ftputil
@@ -14,7 +15,9 @@ from .. import context_managers as cm
 from .. import fs_base as fsb
 from .. import fs_utils as fsu
 from .. import cached_file as chf
+from .. import global_namespace as gns
 from .. import object_cache as objc
+from .. import osfd
 from .. import writeback_file as wbf
 
 
@@ -40,29 +43,87 @@ class CacheHandler(objc.Handler):
     obj.close()
 
 
+_MAX_CONNECTIONS = int(os.getenv('GFS_FTP_MAX_CONNECTIONS', 4))
+# Block reads rely on the REST command, which can be disabled for servers not
+# supporting it (falling back to whole content reads).
+_BLOCK_READS = int(os.getenv('GFS_FTP_BLOCK_READS', 1))
+_CHUNK_SIZE = 1024**2
+
+_SLOTS_LOCK = threading.Lock()
+_CONN_SLOTS = gns.Var(f'{__name__}.CONN_SLOTS', fork_init=True, defval=lambda: dict())
+
+def _connection_slots(name):
+  # Data transfers toward the same host/user are bounded, so that parallel block
+  # fetches do not open an unbounded number of FTP connections.
+  with _SLOTS_LOCK:
+    slots = gns.get(_CONN_SLOTS)
+    sem = slots.get(name)
+    if sem is None:
+      sem = threading.BoundedSemaphore(_MAX_CONNECTIONS)
+      slots[name] = sem
+
+  return sem
+
+
 class FtpReader:
 
-  def __init__(self, conn, path):
-    self._conn = conn
+  def __init__(self, conn_fn, slots, path, size):
+    self._conn_fn = conn_fn
+    self._slots = slots
     self._path = path
+    self._size = size
 
   @classmethod
   def tag(cls, sres):
     return chf.make_tag(size=sres.st_size, mtime=sres.st_mtime)
 
   def support_blocks(self):
-    return False
+    return _BLOCK_READS > 0
 
   def read_block(self, bpath, offset, size):
-    tas.check_eq(offset, chf.CachedBlockFile.WHOLE_OFFSET,
-                 msg=f'Wrong offset for whole content read: {offset}')
+    if offset != chf.CachedBlockFile.WHOLE_OFFSET:
+      size = min(size, self._size - offset)
+      with osfd.OsFd(bpath, os.O_CREAT | os.O_TRUNC | os.O_WRONLY, mode=0o440) as wfd:
+        writer = chf.OffsetWriter(wfd)
+        self._copy_range(offset, size, writer)
+
+        return writer.tell()
+    elif self.support_blocks() and chf.use_parallel_download(self._size):
+      return chf.parallel_download(bpath, self._size, self._read_range,
+                                   stream_fn=self._copy_range)
+    else:
+      with self._slots:
+        conn = self._conn_fn()
+        bfd = os.open(bpath, os.O_CREAT | os.O_TRUNC | os.O_WRONLY, mode=0o440)
+        with open(bfd, mode='wb') as wfd:
+          with conn.open(self._path, mode='rb') as rfd:
+            conn.copyfileobj(rfd, wfd)
+
+      return os.path.getsize(bpath)
+
+  def _copy_range(self, offset, size, fobj):
+    with self._slots:
+      conn = self._conn_fn()
+      # The transfer is started at offset (REST) and dropped once size bytes have
+      # been received, which FTPHost handles when closing the remote file.
+      with conn.open(self._path, mode='rb', rest=offset) as rfd:
+        left = size
+        while left > 0:
+          data = rfd.read(min(left, _CHUNK_SIZE))
+          if not data:
+            break
+
+          fobj.write(data)
+          left -= len(data)
+
+  def _read_range(self, offset, size):
+    bio = io.BytesIO()
+    self._copy_range(offset, size, bio)
 
-    bfd = os.open(bpath, os.O_CREAT | os.O_TRUNC | os.O_WRONLY, mode=0o440)
-    with open(bfd, mode='wb') as wfd:
-      with self._conn.open(self._path, mode='rb') as rfd:
-        self._conn.copyfileobj(rfd, wfd)
+    return bio.getvalue()
 
-    return os.path.getsize(bpath)
+  def read_ranges(self, ranges):
+    return chf.fetch_ranges(self._read_range, ranges)
 
 
 # https://docs.python.org/3/library/ftplib.html
@@ -94,29 +155,37 @@ class FtpFs(fsb.FsBase):
   def _netloc(self, purl):
     return (purl.hostname.lower(), purl.port or 21)
 
-  def _parse_url(self, url):
-    purl = uparse.urlparse(url)
-
+  def _conn_args(self, purl):
     host, port = self._netloc(purl)
     user = purl.username or 'anonymous'
     passwd = purl.password or ''
 
-    conn = self._get_connection(host, port, user, passwd)
+    return host, port, user, passwd
+
+  def _parse_url(self, url):
+    purl = uparse.urlparse(url)
+
+    conn = self._get_connection(*self._conn_args(purl))
 
     return conn, purl
 
-  def _make_reader(self, conn, purl):
-    sres = self._stat(conn, purl.path)
+  def _make_reader(self, url, conn, purl):
+    sres = self._cached_meta(url, 'stat', functools.partial(self._stat, conn, purl.path))
+
+    host, port, user, passwd = self._conn_args(purl)
+    conn_fn = functools.partial(self._get_connection, host, port, user, passwd)
+    slots = _connection_slots((host, port, user))
 
     tag = FtpReader.tag(sres)
     meta = chf.Meta(size=sres.st_size, mtime=sres.st_mtime, tag=tag)
-    reader = FtpReader(conn, purl.path)
+    reader = FtpReader(conn_fn, slots, purl.path, sres.st_size)
 
     return reader, meta
 
   def remove(self, url):
     conn, purl = self._parse_url(url)
     conn.remove(purl.path)
+    self._invalidate_meta(url)
 
   def rename(self, src_url, dest_url):
     src_conn, src_purl = self._parse_url(src_url)
@@ -129,6 +198,8 @@ class FtpFs(fsb.FsBase):
                  f'{src_netloc} vs. {dest_netloc}')
 
     src_conn.rename(src_purl.path, dest_purl.path)
+    self._invalidate_meta(src_url)
+    self._invalidate_meta(dest_url)
 
   def mkdir(self, url, mode=None):
     conn, purl = self._parse_url(url)
@@ -142,11 +213,13 @@ class FtpFs(fsb.FsBase):
   def rmdir(self, url):
     conn, purl = self._parse_url(url)
     conn.rmdir(purl.path)
+    self._invalidate_meta(url)
 
   def rmtree(self, url, ignore_errors=None):
     conn, purl = self._parse_url(url)
 
     conn.rmtree(purl.path, ignore_errors=ignore_errors or False)
+    self._invalidate_meta(url)
 
   def _stat(self, conn, path):
     sres = conn.stat(path)
@@ -164,9 +237,9 @@ class FtpFs(fsb.FsBase):
   def stat(self, url):
     conn, purl = self._parse_url(url)
 
-    return self._stat(conn, purl.path)
+    return self._cached_meta(url, 'stat', functools.partial(self._stat, conn, purl.path))
 
-  def list(self, url):
+  def list(self, url, with_stats=True):
     conn, purl = self._parse_url(url)
 
     for name in conn.listdir(purl.path):
@@ -178,8 +251,9 @@ class FtpFs(fsb.FsBase):
     conn, purl = self._parse_url(url)
 
     if self.read_mode(mode):
-      reader, meta = self._make_reader(conn, purl)
-      cfile = self._cache_iface.open(url, meta, reader, **kwargs)
+      cfile = self._cache_iface.open_url(url,
+                                         functools.partial(self._make_reader, url, conn, purl),
+                                         **kwargs)
 
       return io.TextIOWrapper(cfile) if self.text_mode(mode) else cfile
     else:
@@ -201,6 +275,8 @@ class FtpFs(fsb.FsBase):
     with conn.open(purl.path, mode='wb') as dest_fd:
       conn.copyfileobj(stream, dest_fd)
 
+    self._invalidate_meta(url)
+
   def _download_file(self, url):
     conn, purl = self._parse_url(url)
 
@@ -217,6 +293,8 @@ class FtpFs(fsb.FsBase):
       for data in data_gen:
         fd.write(data)
 
+    self._invalidate_meta(url)
+
   def get_file(self, url):
     conn, purl = self._parse_url(url)
 
@@ -226,13 +304,13 @@ class FtpFs(fsb.FsBase):
 
   def as_local(self, url, **kwargs):
     conn, purl = self._parse_url(url)
-    reader, meta = self._make_reader(conn, purl)
+    reader, meta = self._make_reader(url, conn, purl)
 
     return self._cache_iface.as_local(url, meta, reader, **kwargs)
 
   def link(self, src_url, dest_url):
     # There is not link support in FTP.
-    self.copyfile(src_url, dest_url)
+    self.copyfile(src_url, self, dest_url)
 
   def symlink(self, src_url, dest_url):
     self.link(src_url, dest_url)
@@ -34,6 +34,8 @@ class GcsReader:
     self._fs = fs
     self._path = path
     self._sres = sres
+    # The blob handle is reused for all the reads of the object.
+    self._blob = fs.blob(path)
 
   @classmethod
   def tag(cls, sres):
@@ -45,18 +47,29 @@ class GcsReader:
   def read_block(self, bpath, offset, size):
     if offset != chf.CachedBlockFile.WHOLE_OFFSET:
       size = min(size, self._sres.st_size - offset)
-      data = self._fs.pread(self._path, offset, size)
-
       with osfd.OsFd(bpath, os.O_CREAT | os.O_TRUNC | os.O_WRONLY, mode=0o440) as wfd:
-        os.write(wfd, data)
+        writer = chf.OffsetWriter(wfd)
+        self._stream_range(offset, size, writer)
 
-      return len(data)
+        return writer.tell()
+    elif chf.use_parallel_download(self._sres.st_size):
+      return chf.parallel_download(bpath, self._sres.st_size, self._read_range,
+                                   stream_fn=self._stream_range)
     else:
       with osfd.OsFd(bpath, os.O_CREAT | os.O_TRUNC | os.O_WRONLY, mode=0o440) as wfd:
-        for data in self._fs.download(self._path):
-          os.write(wfd, data)
+        writer = chf.OffsetWriter(wfd)
+        self._fs.download_to(self._path, writer, blob=self._blob)
+
+        return writer.tell()
+
+  def _stream_range(self, offset, size, fobj):
+    self._fs.download_to(self._path, fobj, offset=offset, size=size, blob=self._blob)
 
-      return os.path.getsize(bpath)
+  def _read_range(self, offset, size):
+    return self._fs.pread(self._path, offset, size, blob=self._blob)
+
+  def read_ranges(self, ranges):
+    return chf.fetch_ranges(self._read_range, ranges)
 
 
 class GcsFs(fsb.FsBase):
@@ -80,12 +93,15 @@ class GcsFs(fsb.FsBase):
 
     return fs, purl
 
-  def _make_reader(self, fs, purl):
-    sres = fs.stat(purl.path)
+  def _stat(self, url, fs, purl):
+    return self._cached_meta(url, 'stat', functools.partial(fs.stat, purl.path))
+
+  def _make_reader(self, url, fs, purl):
+    sres = self._stat(url, fs, purl)
     tas.check_is_not_none(sres, msg=f'File does not exist: {purl.geturl()}')
 
     tag = GcsReader.tag(sres)
-    meta = chf.Meta(size=sres.st_size, mtime=sres.st_mtime, tag=tag)
+    meta = chf.Meta(size=sres.st_size, mtime=sres.st_mtime, tag=tag, digest=sres.digest)
     reader = GcsReader(fs, purl.path, sres)
 
     return reader, meta
@@ -104,15 +120,31 @@ class GcsFs(fsb.FsBase):
     (src_fs, src_purl), (dest_fs, dest_purl) = self._parse_samefs(src_url, dest_url)
 
     src_fs.copy(src_purl.path, dest_purl.path)
+    self._invalidate_meta(dest_url)
+
+  def server_copy(self, url, dest_fs, dest_url):
+    if isinstance(dest_fs, GcsFs):
+      src_fs, src_purl = self._parse_url(url)
+      dest_purl = uparse.urlparse(dest_url)
+
+      src_fs.copy(src_purl.path, dest_purl.path.lstrip('/'), dest_bucket=dest_purl.hostname)
+      self._invalidate_meta(dest_url)
+
+      return True
+
+    return False
 
   def remove(self, url):
     fs, purl = self._parse_url(url)
     fs.remove(purl.path)
+    self._invalidate_meta(url)
 
   def rename(self, src_url, dest_url):
     (src_fs, src_purl), (dest_fs, dest_purl) = self._parse_samefs(src_url, dest_url)
 
     src_fs.rename(src_purl.path, dest_purl.path)
+    self._invalidate_meta(src_url)
+    self._invalidate_meta(dest_url)
 
   def mkdir(self, url, mode=None):
     pass
@@ -127,23 +159,25 @@ class GcsFs(fsb.FsBase):
     fs, purl = self._parse_url(url)
 
     fs.rmtree(purl.path, ignore_errors=ignore_errors or False)
+    self._invalidate_meta(url)
 
   def stat(self, url):
     fs, purl = self._parse_url(url)
 
-    return fs.stat(purl.path)
+    return self._stat(url, fs, purl)
 
-  def list(self, url):
+  def list(self, url, with_stats=True):
     fs, purl = self._parse_url(url)
 
-    return fs.listdir(purl.path)
+    return self._cached_list(url, functools.partial(fs.scandir, purl.path))
 
   def open(self, url, mode, **kwargs):
     fs, purl = self._parse_url(url)
 
     if self.read_mode(mode):
-      reader, meta = self._make_reader(fs, purl)
-      cfile = self._cache_iface.open(url, meta, reader, **kwargs)
+      cfile = self._cache_iface.open_url(url,
+                                         functools.partial(self._make_reader, url, fs, purl),
+                                         **kwargs)
 
       return io.TextIOWrapper(cfile) if self.text_mode(mode) else cfile
     else:
@@ -173,6 +207,7 @@ class GcsFs(fsb.FsBase):
     fs, purl = self._parse_url(url)
 
     fs.upload(purl.path, data_gen)
+    self._invalidate_meta(url)
 
   def get_file(self, url):
     fs, purl = self._parse_url(url)
@@ -181,7 +216,7 @@ class GcsFs(fsb.FsBase):
 
   def as_local(self, url, **kwargs):
     fs, purl = self._parse_url(url)
-    reader, meta = self._make_reader(fs, purl)
+    reader, meta = self._make_reader(url, fs, purl)
 
     return self._cache_iface.as_local(url, meta, reader, **kwargs)
 
@@ -1,3 +1,4 @@
+import collections
 import functools
 import hashlib
 import io
@@ -9,22 +10,117 @@ import stat as st
 import tempfile
 
 import bs4
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+  import httpx
+except ImportError:
+  httpx = None
 
 from .. import alog
 from .. import assert_checks as tas
 from .. import context_managers as cm
 from .. import fs_base as fsb
+from .. import executor as xe
 from .. import fs_utils as fsu
 from .. import cached_file as chf
+from .. import global_namespace as gns
 from .. import http_utils as hu
 from .. import osfd
 from .. import writeback_file as wbf
 
 
+_POOL_CONNECTIONS = int(os.getenv('GFS_HTTP_POOL_CONNECTIONS', 16))
+_POOL_MAXSIZE = int(os.getenv('GFS_HTTP_POOL_MAXSIZE', 32))
+_RETRIES = int(os.getenv('GFS_HTTP_RETRIES', 3))
+_RETRY_BACKOFF = float(os.getenv('GFS_HTTP_RETRY_BACKOFF', 0.5))
+# The transport used for ranged GETs. The "httpx" one multiplexes the concurrent
+# range fetches of a file over few HTTP/2 connections, when the server supports it.
+_RANGE_TRANSPORT = os.getenv('GFS_HTTP_RANGE_TRANSPORT', 'requests')
+_HEAD_WORKERS = int(os.getenv('GFS_HTTP_HEAD_WORKERS', 16))
+
+_HEAD_EXECUTOR = gns.Var(f'{__name__}.HEAD_EXECUTOR',
+                         fork_init=True,
+                         defval=lambda: xe.Executor(max_threads=_HEAD_WORKERS,
+                                                    name_prefix='HttpHead'))
+
+def _make_session(pool_connections=None, pool_maxsize=None, retries=None):
+  retry = Retry(total=retries if retries is not None else _RETRIES,
+                backoff_factor=_RETRY_BACKOFF,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=('HEAD', 'GET', 'OPTIONS'),
+                raise_on_status=False)
+  adapter = HTTPAdapter(pool_connections=pool_connections or _POOL_CONNECTIONS,
+                        pool_maxsize=pool_maxsize or _POOL_MAXSIZE,
+                        max_retries=retry)
+
+  session = requests.Session()
+  session.mount('http://', adapter)
+  session.mount('https://', adapter)
+
+  return session
+
+
+def _make_range_client(req_kwargs, transport=None, pool_maxsize=None, retries=None):
+  transport = transport or _RANGE_TRANSPORT
+  if transport == 'requests':
+    return None
+
+  tas.check_eq(transport, 'httpx', msg=f'Unknown HTTP range transport: {transport}')
+  if httpx is None:
+    alog.warning(f'The "httpx" module is not available, using "requests" for range fetches')
+    return None
+
+  # Only the client level arguments which have a direct "httpx" equivalent are mapped.
+  client_kwargs = dict()
+  for arg in ('headers', 'timeout', 'auth', 'cookies'):
+    if (argv := req_kwargs.get(arg)) is not None:
+      client_kwargs[arg] = argv
+
+  pool_maxsize = pool_maxsize or _POOL_MAXSIZE
+  limits = httpx.Limits(max_connections=pool_maxsize,
+                        max_keepalive_connections=pool_maxsize)
+  http_transport = httpx.HTTPTransport(http2=True,
+                                       limits=limits,
+                                       retries=retries if retries is not None else _RETRIES,
+                                       verify=req_kwargs.get('verify', True),
+                                       cert=req_kwargs.get('cert'))
+
+  return httpx.Client(transport=http_transport,
+                      follow_redirects=req_kwargs.get('allow_redirects', True),
+                      **client_kwargs)
+
+
+def _trim_range(offset, size, headers, chunks):
+  # Servers not supporting ranges might return the whole content (or a range
+  # starting before the requested one), so the leading bytes must be skipped.
+  hrange = hu.range(headers)
+  skip = offset - (hrange.start if hrange is not None else 0)
+  left = size
+  for data in chunks:
+    if skip > 0:
+      if len(data) <= skip:
+        skip -= len(data)
+        continue
+      data = memoryview(data)[skip:]
+      skip = 0
+
+    if len(data) > left:
+      data = memoryview(data)[: left]
+
+    yield data
+
+    left -= len(data)
+    if left <= 0:
+      break
+
+
 class HttpReader:
 
-  def __init__(self, url, session=None, head=None, req_kwargs=None, chunk_size=None):
-    session = session if session is not None else requests.Session()
+  def __init__(self, url, session=None, head=None, req_kwargs=None, chunk_size=None,
+               range_client=None):
+    session = session if session is not None else _make_session()
     req_kwargs = req_kwargs or dict()
     if head is None:
       head = hu.info(url, mod=session, **req_kwargs)
@@ -33,8 +129,10 @@ class HttpReader:
 
     self._url = url
     self._session = session
+    self._range_client = range_client
     self._req_kwargs = req_kwargs
     self._chunk_size = chunk_size or 16 * 1024**2
+    self._range_chunk_size = min(self._chunk_size, 1024**2)
     self._size = hu.content_length(head.headers)
     self._support_blocks = self._size is not None and allow_ranges
 
@@ -53,19 +151,16 @@ class HttpReader:
 
   def read_block(self, bpath, offset, size):
     if self._support_blocks and offset != chf.CachedBlockFile.WHOLE_OFFSET:
+      size = min(size, self._size - offset)
       with osfd.OsFd(bpath, os.O_CREAT | os.O_TRUNC | os.O_WRONLY, mode=0o440) as wfd:
-        size = min(size, self._size - offset)
-
-        headers = self._req_kwargs.get('headers', dict()).copy()
-        hu.add_range(headers, offset, offset + size)
-
-        resp = self._session.get(self._url, headers=headers)
-        resp.raise_for_status()
-        data = hu.range_data(offset, offset + size - 1, resp.headers, resp.content)
-
-        os.write(wfd, data)
+        rsize = 0
+        for data in self._stream_range(offset, size):
+          os.write(wfd, data)
+          rsize += len(data)
 
-        return len(data)
+        return rsize
+    elif self._support_blocks and chf.use_parallel_download(self._size):
+      return chf.parallel_download(bpath, self._size, self._read_range)
     else:
       resp = self._session.get(self._url, stream=True, **self._req_kwargs)
       resp.raise_for_status()
@@ -75,6 +170,37 @@ class HttpReader:
 
       return os.path.getsize(bpath)
 
+  def _stream_range(self, offset, size):
+    headers = self._req_kwargs.get('headers', dict()).copy()
+    hu.add_range(headers, offset, offset + size)
+
+    if self._range_client is not None:
+      with self._range_client.stream('GET', self._url, headers=headers) as resp:
+        resp.raise_for_status()
+        chunks = resp.iter_bytes(chunk_size=self._range_chunk_size)
+
+        yield from _trim_range(offset, size, resp.headers, chunks)
+    else:
+      req_kwargs = self._req_kwargs.copy()
+      req_kwargs['headers'] = headers
+
+      with self._session.get(self._url, stream=True, **req_kwargs) as resp:
+        resp.raise_for_status()
+        chunks = resp.iter_content(chunk_size=self._range_chunk_size)
+
+        yield from _trim_range(offset, size, resp.headers, chunks)
+
+  def _read_range(self, offset, size):
+    return b''.join(self._stream_range(offset, size))
+
+  def read_ranges(self, ranges):
+    return chf.fetch_ranges(self._read_range, ranges)
+
+
+def _is_missing(ex):
+  return (isinstance(ex, requests.exceptions.HTTPError) and ex.response is not None and
+          ex.response.status_code in (404, 410))
+
 
 class HttpFs(fsb.FsBase):
 
@@ -86,18 +212,46 @@ class HttpFs(fsb.FsBase):
   def __init__(self, cache_iface=None, **kwargs):
     super().__init__(cache_iface=cache_iface, **kwargs)
     self._req_kwargs = hu.filter_request_args(kwargs)
-    self._session = requests.Session()
+    self._session = _make_session(pool_connections=kwargs.get('pool_connections'),
+                                  pool_maxsize=kwargs.get('pool_maxsize'),
+                                  retries=kwargs.get('retries'))
+    self._range_client = _make_range_client(self._req_kwargs,
+                                            transport=kwargs.get('range_transport'),
+                                            pool_maxsize=kwargs.get('pool_maxsize'),
+                                            retries=kwargs.get('retries'))
+
+  def _not_modified(self, url, head):
+    headers = self._req_kwargs.get('headers', dict()).copy()
+    if (etag := head.headers.get(hu.ETAG)) is not None:
+      headers['If-None-Match'] = etag
+    elif (mtime := head.headers.get(hu.LAST_MODIFIED)) is not None:
+      headers['If-Modified-Since'] = mtime
+    else:
+      return False
+
+    req_kwargs = self._req_kwargs.copy()
+    req_kwargs['headers'] = headers
+
+    resp = self._session.head(url, **req_kwargs)
+
+    return resp.status_code == 304
+
+  def _head(self, url):
+    return self._cached_meta(url, 'head',
+                             lambda: hu.info(url, mod=self._session, **self._req_kwargs),
+                             revalidate_fn=functools.partial(self._not_modified, url),
+                             is_missing=_is_missing)
 
   def _exists(self, url):
     try:
-      hu.info(url, mod=self._session, **self._req_kwargs)
+      self._head(url)
 
       return True
     except requests.exceptions.HTTPError:
       return False
 
   def _make_reader(self, url):
-    head = hu.info(url, mod=self._session, **self._req_kwargs)
+    head = self._head(url)
 
     tag = HttpReader.tag(head)
     size = hu.content_length(head.headers)
@@ -106,12 +260,13 @@ class HttpFs(fsb.FsBase):
     reader = HttpReader(url,
                         session=self._session,
                         head=head,
-                        req_kwargs=self._req_kwargs)
+                        req_kwargs=self._req_kwargs,
+                        range_client=self._range_client)
 
     return reader, meta
 
   def stat(self, url):
-    head = hu.info(url, mod=self._session, **self._req_kwargs)
+    head = self._head(url)
 
     length = hu.content_length(head.headers)
     mtime = hu.last_modified(head.headers)
@@ -129,8 +284,9 @@ class HttpFs(fsb.FsBase):
 
   def open(self, url, mode, **kwargs):
     if self.read_mode(mode):
-      reader, meta = self._make_reader(url)
-      cfile = self._cache_iface.open(url, meta, reader, **kwargs)
+      cfile = self._cache_iface.open_url(url,
+                                         functools.partial(self._make_reader, url),
+                                         **kwargs)
 
       return io.TextIOWrapper(cfile) if self.text_mode(mode) else cfile
     else:
@@ -147,6 +303,7 @@ class HttpFs(fsb.FsBase):
 
   def remove(self, url):
     self._session.delete(url, **self._req_kwargs)
+    self._invalidate_meta(url)
 
   def rename(self, src_url, dest_url):
     # There is no "rename" in HTTP ...
@@ -167,24 +324,60 @@ class HttpFs(fsb.FsBase):
   def rmtree(self, url, ignore_errors=None):
     pass
 
-  def list(self, url):
+  def _link_stat(self, lurl):
+    try:
+      return self.stat(lurl)
+    except Exception as ex:
+      alog.debug(f'Unable to stat URL {lurl}: {ex}')
+
+  def list(self, url, with_stats=True):
     resp = self._session.get(url, **self._req_kwargs)
     resp.raise_for_status()
 
     html_parser = bs4.BeautifulSoup(resp.text, 'html.parser')
 
+    lurls = []
     for link in html_parser.find_all('a'):
       href = link.get('href')
       if href and not re.match(r'[a-zA-Z]+://', href):
-        lurl = os.path.join(url, href)
-        try:
-          de = self.stat(lurl)
-
+        lurls.append(os.path.join(url, href))
+
+    if with_stats:
+      # The HEAD requests for the links are issued concurrently, while the results
+      # are streamed in page order.
+      executor = gns.get(_HEAD_EXECUTOR)
+      inflight = collections.deque()
+      for lurl in lurls:
+        inflight.append(executor.submit_result(self._link_stat, lurl))
+        if len(inflight) >= 2 * _HEAD_WORKERS:
+          if (de := inflight.popleft().wait()) is not None:
+            yield de
+
+      while inflight:
+        if (de := inflight.popleft().wait()) is not None:
           yield de
-        except GeneratorExit:
-          raise
-        except Exception as ex:
-          alog.debug(f'Unable to stat URL {lurl}: {ex}')
+    else:
+      for lurl in lurls:
+        yield fsb.DirEntry(name=os.path.basename(lurl.rstrip('/')),
+                           path=lurl,
+                           st_mode=st.S_IFDIR if lurl.endswith('/') else st.S_IFREG,
+                           st_size=None,
+                           st_ctime=None,
+                           st_mtime=None)
+
+  def _walk_url(self, url, de):
+    return de.path
+
+  def _is_walk_dir(self, url, de):
+    # Only the sub-directory links of an index page are followed, and not parent,
+    # absolute or sorting ones (like "../", "/" or "?C=M;O=A").
+    if not de.path.startswith(url):
+      return False
+
+    rpath = de.path[len(url):].lstrip('/')
+
+    return (rpath.endswith('/') and rpath.count('/') == 1 and
+            re.search(r'[?#]|^\.\.?/$', rpath) is None)
 
   def _upload_data_gen(self, url, data_gen):
     ctype, cencoding = mimetypes.guess_type(url, strict=False)
@@ -196,6 +389,7 @@ class HttpFs(fsb.FsBase):
       headers[hu.CONTENT_ENCODING] = cencoding
 
     self._session.put(url, headers=headers, data=data_gen)
+    self._invalidate_meta(url)
 
   def _upload_file(self, url, stream):
     stream.seek(0)
@@ -231,7 +425,7 @@ class HttpFs(fsb.FsBase):
 
   def link(self, src_url, dest_url):
     # There is not link support in HTTP.
-    self.copyfile(src_url, dest_url)
+    self.copyfile(src_url, self, dest_url)
 
   def symlink(self, src_url, dest_url):
     self.link(src_url, dest_url)
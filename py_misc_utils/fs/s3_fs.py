@@ -1,19 +1,25 @@
 import collections
 import functools
 import io
+import itertools
 import os
+import queue
+import re
 import stat as st
 import tempfile
+import threading
 import urllib.parse as uparse
 
 import boto3
+import botocore.exceptions
 
 from .. import alog as alog
-from .. import assert_checks as tas
 from .. import cached_file as chf
+from .. import context_managers as cm
+from .. import executor as xe
 from .. import fs_base as fsb
 from .. import fs_utils as fsu
-from .. import iter_file as itf
+from .. import global_namespace as gns
 from .. import object_cache as objc
 from .. import osfd as osfd
 from .. import utils as ut
@@ -75,6 +81,13 @@ def _create_client(creds):
   )
 
 
+def _md5_digest(etag):
+  # ETags of objects uploaded with a single PUT are the MD5 of their content, while
+  # the multipart ones have a "-NPARTS" suffix.
+  if etag is not None and re.fullmatch(r'[0-9a-f]{32}', etag):
+    return etag
+
+
 def _make_dentry(resp, path, base_path=None):
   etag = resp.get('ETag', '').strip('"\'')
   etag = etag or None
@@ -109,6 +122,7 @@ def _make_dentry(resp, path, base_path=None):
   return fsb.DirEntry(name=name,
                       path=path,
                       etag=etag,
+                      digest=_md5_digest(etag),
                       st_mode=mode,
                       st_size=size,
                       st_ctime=mtime,
@@ -140,6 +154,25 @@ def _stat_object(client, bucket, path):
   return _make_dentry(response, path)
 
 
+def _error_code(ex):
+  if isinstance(ex, botocore.exceptions.ClientError):
+    return ex.response.get('Error', dict()).get('Code')
+
+
+def _is_missing(ex):
+  return isinstance(ex, FileNotFoundError) or _error_code(ex) in ('404', 'NoSuchKey', 'NotFound')
+
+
+def _not_modified(client, bucket, path, sres):
+  if sres.etag:
+    try:
+      client.head_object(Bucket=bucket, Key=path, IfNoneMatch=f'"{sres.etag}"')
+    except botocore.exceptions.ClientError as ex:
+      return _error_code(ex) in ('304', 'NotModified')
+
+  return False
+
+
 def _norm_path(path):
   if path:
     if path == '/':
@@ -150,18 +183,32 @@ def _norm_path(path):
   return path
 
 
-def _list_objects(client, bucket, path, flat=True):
+_LIST_WORKERS = int(os.getenv('GFS_S3_LIST_WORKERS', 8))
+_LIST_QUEUE_SIZE = 64
+_DELETE_WORKERS = int(os.getenv('GFS_S3_DELETE_WORKERS', 8))
+_DELETE_BATCH = 1000
+
+_LIST_EXECUTOR = gns.Var(f'{__name__}.LIST_EXECUTOR',
+                         fork_init=True,
+                         defval=lambda: xe.Executor(max_threads=_LIST_WORKERS,
+                                                    name_prefix='S3List'))
+_DELETE_EXECUTOR = gns.Var(f'{__name__}.DELETE_EXECUTOR',
+                           fork_init=True,
+                           defval=lambda: xe.Executor(max_threads=_DELETE_WORKERS,
+                                                      name_prefix='S3Delete'))
+
+
+def _list_pages(client, bucket, path, delimiter=None):
   kwargs = dict()
+  if delimiter is not None:
+    kwargs['Delimiter'] = delimiter
+
   while True:
     response = client.list_objects_v2(Bucket=bucket,
                                       Prefix=path,
                                       **kwargs)
 
-    objects = response.get('Contents', ())
-    for obj in objects:
-      dentry = _make_dentry(obj, obj['Key'], base_path=None if flat else path)
-      if dentry is not None:
-        yield dentry
+    yield response
 
     if not response.get('IsTruncated', False):
       break
@@ -169,9 +216,82 @@ def _list_objects(client, bucket, path, flat=True):
     kwargs['ContinuationToken'] = response['NextContinuationToken']
 
 
+_END = object()
+
+def _queue_put(rqueue, item, stop):
+  # The consumer might stop reading results, in which case the stop event is set.
+  while not stop.is_set():
+    try:
+      rqueue.put(item, timeout=0.5)
+
+      return True
+    except queue.Full:
+      pass
+
+  return False
+
+
+def _list_prefix_worker(client, bucket, prefixes, rqueue, stop):
+  try:
+    for prefix in prefixes:
+      for response in _list_pages(client, bucket, prefix):
+        objects = response.get('Contents', ())
+        if objects and not _queue_put(rqueue, objects, stop):
+          return
+  except Exception as ex:
+    _queue_put(rqueue, ex, stop)
+  finally:
+    _queue_put(rqueue, _END, stop)
+
+
+def _parallel_list(client, bucket, path):
+  # The sub-prefixes discovered with a delimiter based listing are listed
+  # concurrently, while objects are streamed to the caller as they arrive.
+  prefixes = []
+  for response in _list_pages(client, bucket, path, delimiter='/'):
+    yield from response.get('Contents', ())
+
+    prefixes.extend(cpfx['Prefix'] for cpfx in response.get('CommonPrefixes', ()))
+
+  if prefixes:
+    nworkers = min(_LIST_WORKERS, len(prefixes))
+    rqueue = queue.Queue(maxsize=_LIST_QUEUE_SIZE)
+    stop = threading.Event()
+    executor = gns.get(_LIST_EXECUTOR)
+    try:
+      for i in range(nworkers):
+        executor.submit(_list_prefix_worker, client, bucket, prefixes[i:: nworkers],
+                        rqueue, stop)
+
+      running = nworkers
+      while running > 0:
+        objects = rqueue.get()
+        if objects is _END:
+          running -= 1
+        elif isinstance(objects, Exception):
+          raise objects
+        else:
+          yield from objects
+    finally:
+      stop.set()
+
+
+def _list_objects(client, bucket, path, flat=True, parallel=False):
+  if parallel and _LIST_WORKERS > 1:
+    objects = _parallel_list(client, bucket, path)
+  else:
+    objects = itertools.chain.from_iterable(response.get('Contents', ())
+                                            for response in _list_pages(client, bucket, path))
+
+  for obj in objects:
+    dentry = _make_dentry(obj, obj['Key'], base_path=None if flat else path)
+    if dentry is not None:
+      yield dentry
+
+
 def _list(client, bucket, path):
   dentries = dict()
-  for dentry in _list_objects(client, bucket, path, flat=False):
+  for dentry in _list_objects(client, bucket, path, flat=False, parallel=True):
     xdentry = dentries.get(dentry.name)
     if xdentry is not None:
       dentry = dentry._replace(st_ctime=min(dentry.st_ctime, xdentry.st_ctime),
@@ -184,6 +304,31 @@ def _list(client, bucket, path):
     yield dentry
 
 
+def _list_dir(client, bucket, path):
+  # Lists a single directory level, using the "/" delimiter, so that the objects
+  # within sub-directories are not fetched. Entries are streamed page by page (in
+  # S3 key order). Sub-directories have no times, as those would require listing
+  # their whole content.
+  if path and not path.endswith('/'):
+    path = path + '/'
+
+  for response in _list_pages(client, bucket, path, delimiter='/'):
+    for cpfx in response.get('CommonPrefixes', ()):
+      name = cpfx['Prefix'][len(path):].rstrip('/')
+      yield fsb.DirEntry(name=name,
+                         path=path + name,
+                         st_mode=st.S_IFDIR,
+                         st_size=0,
+                         st_ctime=None,
+                         st_mtime=None)
+
+    for obj in response.get('Contents', ()):
+      dentry = _make_dentry(obj, obj['Key'], base_path=path)
+      # Directory marker objects (whose key is the prefix itself) have no name.
+      if dentry is not None and dentry.name:
+        yield dentry
+
+
 def _stat(client, bucket, path):
   dentries = tuple(_list(client, bucket, path))
 
@@ -205,28 +350,326 @@ def _stat(client, bucket, path):
                         st_mtime=mtime)
 
 
+def _delete_objects(client, bucket, paths, ignore_errors=None):
+  response = client.delete_objects(
+    Bucket=bucket,
+    Delete=dict(Objects=[dict(Key=path) for path in paths], Quiet=True),
+  )
+
+  errors = response.get('Errors', ())
+  for error in errors:
+    alog.debug(f'Failed to remove the {bucket}:{error.get("Key")} object: ' \
+               f'{error.get("Code")} {error.get("Message")}')
+
+  if errors and ignore_errors in (None, False):
+    alog.xraise(RuntimeError, f'Failed to remove {len(errors)} objects from {bucket}, ' \
+                f'like {errors[0].get("Key")}: {errors[0].get("Message")}')
+
+
 def _rmtree(client, bucket, path, ignore_errors=None):
-  # List all before to prevent possible erros deriving from delete-while-listing.
-  dentries = tuple(_list_objects(client, bucket, _norm_path(path)))
+  # Listing with continuation tokens is not affected by the removal of the objects
+  # which have already been listed, so deletes can run while listing.
+  executor = gns.get(_DELETE_EXECUTOR)
+  slots = threading.Semaphore(2 * _DELETE_WORKERS)
+
+  def delete_batch(paths):
+    try:
+      _delete_objects(client, bucket, paths, ignore_errors=ignore_errors)
+    finally:
+      slots.release()
+
+  aresults, paths = [], []
+  try:
+    for dentry in _list_objects(client, bucket, _norm_path(path), parallel=True):
+      paths.append(dentry.path)
+      if len(paths) >= _DELETE_BATCH:
+        slots.acquire()
+        aresults.append(executor.submit_result(delete_batch, paths))
+        paths = []
+
+    if paths:
+      slots.acquire()
+      aresults.append(executor.submit_result(delete_batch, paths))
+  finally:
+    # Wait all the submitted batches, and re-raise the first error (if any).
+    errors = []
+    for aresult in aresults:
+      try:
+        aresult.wait()
+      except Exception as ex:
+        errors.append(ex)
+
+  if errors:
+    raise errors[0]
+
+
+_CHUNK_SIZE = 1024**2
+_PART_SIZE = int(os.getenv('GFS_S3_PART_SIZE', 64 * 1024**2))
+_MIN_PART_SIZE = 5 * 1024**2
+_MAX_PARTS = 10000
+_UPLOAD_WORKERS = int(os.getenv('GFS_S3_UPLOAD_WORKERS', 8))
+_UPLOAD_INFLIGHT = int(os.getenv('GFS_S3_UPLOAD_INFLIGHT', 4))
+
+_UPLOAD_EXECUTOR = gns.Var(f'{__name__}.UPLOAD_EXECUTOR',
+                           fork_init=True,
+                           defval=lambda: xe.Executor(max_threads=_UPLOAD_WORKERS,
+                                                      name_prefix='S3Upload'))
+
+def _upload_executor():
+  return gns.get(_UPLOAD_EXECUTOR)
+
+
+def _stream_size(stream):
+  if hasattr(stream, 'seekable') and stream.seekable():
+    pos = stream.tell()
+    size = stream.seek(0, os.SEEK_END)
+    stream.seek(pos, os.SEEK_SET)
+
+    return size - pos
+
+
+def _part_size(size=None, part_size=None):
+  part_size = max(part_size or _PART_SIZE, _MIN_PART_SIZE)
+  if size is not None:
+    # Objects cannot have more than _MAX_PARTS parts.
+    part_size = max(part_size, (size + _MAX_PARTS - 1) // _MAX_PARTS)
+
+  return part_size
+
+
+def _iter_parts(body, part_size):
+  if hasattr(body, 'read'):
+    body = fsu.enum_chunks(body, chunk_size=part_size)
+
+  buf = bytearray()
+  for data in body:
+    buf += data
+    while len(buf) >= part_size:
+      yield bytes(buf[: part_size])
+      del buf[: part_size]
+
+  if buf:
+    yield bytes(buf)
+
+
+class _MultipartUpload:
+
+  # Parts are uploaded concurrently, but no more than _UPLOAD_INFLIGHT at any given
+  # time, so that the memory used by an upload is bounded.
+
+  def __init__(self, client, bucket, path):
+    self._client = client
+    self._bucket = bucket
+    self._path = path
+    self._slots = threading.Semaphore(_UPLOAD_INFLIGHT)
+    self._failed = threading.Event()
+    self._aresults = []
+
+    response = client.create_multipart_upload(Bucket=bucket, Key=path)
+    self._upload_id = response['UploadId']
 
-  for dentry in dentries:
+  def _run_part(self, part_number, upload_fn):
     try:
-      client.delete_object(Bucket=bucket, Key=dentry.path)
+      return dict(ETag=upload_fn(part_number), PartNumber=part_number)
+    except:
+      self._failed.set()
+      raise
+    finally:
+      self._slots.release()
+
+  def _wait_parts(self):
+    return [aresult.wait() for aresult in self._aresults]
+
+  def _submit(self, upload_fn):
+    self._slots.acquire()
+    if self._failed.is_set():
+      self._slots.release()
+      # This re-raises the exception of the failed part.
+      self._wait_parts()
+
+    self._aresults.append(_upload_executor().submit_result(self._run_part,
+                                                           len(self._aresults) + 1,
+                                                           upload_fn))
+
+  def _put_part(self, data, part_number):
+    response = self._client.upload_part(
+      Bucket=self._bucket,
+      Key=self._path,
+      UploadId=self._upload_id,
+      PartNumber=part_number,
+      Body=data,
+    )
+
+    return response['ETag']
+
+  def _copy_part(self, copy_source, offset, size, part_number):
+    response = self._client.upload_part_copy(
+      Bucket=self._bucket,
+      Key=self._path,
+      UploadId=self._upload_id,
+      PartNumber=part_number,
+      CopySource=copy_source,
+      CopySourceRange=f'bytes={offset}-{offset + size - 1}',
+    )
+
+    return response['CopyPartResult']['ETag']
+
+  def add_part(self, data):
+    self._submit(functools.partial(self._put_part, data))
+
+  def add_copy_part(self, copy_source, offset, size):
+    self._submit(functools.partial(self._copy_part, copy_source, offset, size))
+
+  def complete(self):
+    self._client.complete_multipart_upload(
+      Bucket=self._bucket,
+      Key=self._path,
+      UploadId=self._upload_id,
+      MultipartUpload=dict(Parts=self._wait_parts()),
+    )
+
+  def abort(self):
+    alog.debug(f'Aborting multipart upload of {self._bucket}:{self._path} ' \
+               f'({self._upload_id})')
+    for aresult in self._aresults:
+      try:
+        aresult.wait()
+      except Exception:
+        pass
+
+    try:
+      self._client.abort_multipart_upload(Bucket=self._bucket,
+                                          Key=self._path,
+                                          UploadId=self._upload_id)
     except Exception as ex:
-      alog.debug(f'Failed to remove the {bucket}:{dentry.path} object: {ex}')
-      if ignore_errors in (None, False):
+      alog.warning(f'Unable to abort multipart upload of {self._bucket}:{self._path}: {ex}')
+
+
+def _multipart_upload(client, bucket, path, parts):
+  upload = _MultipartUpload(client, bucket, path)
+  try:
+    for data in parts:
+      upload.add_part(data)
+
+    upload.complete()
+  except:
+    upload.abort()
+    raise
+
+
+def _write_object(client, bucket, path, body, part_size=None):
+  # Small objects go with a single PUT, while the ones larger than a part are
+  # streamed with a multipart upload.
+  size = _stream_size(body) if hasattr(body, 'read') else None
+  part_size = _part_size(size=size, part_size=part_size)
+  parts = _iter_parts(body, part_size)
+
+  part = next(parts, b'')
+  if len(part) < part_size:
+    client.put_object(Bucket=bucket, Key=path, Body=part)
+  else:
+    parts = itertools.chain([part], parts)
+    del part
+
+    _multipart_upload(client, bucket, path, parts)
+
+
+_MAX_COPY_SIZE = 5 * 1024**3
+_COPY_PART_SIZE = int(os.getenv('GFS_S3_COPY_PART_SIZE', 512 * 1024**2))
+
+def _copy_object(client, src_bucket, src_path, dest_bucket, dest_path):
+  # Objects larger than _MAX_COPY_SIZE cannot be copied with a single CopyObject
+  # request, and need a multipart upload with server side copied parts.
+  copy_source = dict(Bucket=src_bucket, Key=src_path)
+
+  response = client.head_object(Bucket=src_bucket, Key=src_path)
+  size = response['ContentLength']
+  if size <= _MAX_COPY_SIZE:
+    client.copy_object(Bucket=dest_bucket, CopySource=copy_source, Key=dest_path)
+  else:
+    part_size = _part_size(size=size, part_size=_COPY_PART_SIZE)
+
+    upload = _MultipartUpload(client, dest_bucket, dest_path)
+    try:
+      for offset in range(0, size, part_size):
+        upload.add_copy_part(copy_source, offset, min(part_size, size - offset))
+
+      upload.complete()
+    except:
+      upload.abort()
+      raise
+
+
+class S3Writer(io.RawIOBase):
+
+  # Streams the written data to S3, with a multipart upload if the data does not
+  # fit a single part. The object is created only when the writer is closed, and
+  # an exception raised within a "with" block aborts the upload.
+
+  def __init__(self, client, bucket, path, part_size=None, close_fn=None):
+    super().__init__()
+    self._client = client
+    self._bucket = bucket
+    self._path = path
+    self._part_size = _part_size(part_size=part_size)
+    self._close_fn = close_fn
+    self._buffer = bytearray()
+    self._upload = None
+
+  def writable(self):
+    return True
+
+  def write(self, data):
+    self._buffer += data
+    try:
+      while len(self._buffer) >= self._part_size:
+        if self._upload is None:
+          self._upload = _MultipartUpload(self._client, self._bucket, self._path)
+
+        self._upload.add_part(bytes(self._buffer[: self._part_size]))
+        del self._buffer[: self._part_size]
+    except:
+      self.abort()
+      raise
+
+    return len(data)
+
+  def _commit(self):
+    if self._upload is None:
+      self._client.put_object(Bucket=self._bucket, Key=self._path, Body=bytes(self._buffer))
+    else:
+      try:
+        if self._buffer:
+          self._upload.add_part(bytes(self._buffer))
+
+        self._upload.complete()
+      except:
+        self._upload.abort()
         raise
 
+    if self._close_fn is not None:
+      self._close_fn()
 
-def _write_object(client, bucket, path, body):
-  if isinstance(body, collections.abc.Iterator) and not hasattr(body, 'seek'):
-    body = itf.IterFile(body)
+  def close(self):
+    if not self.closed:
+      try:
+        if self._buffer is not None:
+          self._commit()
+      finally:
+        self._buffer = self._upload = None
+        super().close()
 
-  response = client.put_object(
-    Bucket=bucket,
-    Key=path,
-    Body=body,
-  )
+  def abort(self):
+    if self._upload is not None:
+      self._upload.abort()
+    self._buffer = self._upload = None
+
+  def __exit__(self, exc_type, *exc_args):
+    if exc_type is not None:
+      self.abort()
+    self.close()
+
+    return False
 
 
 class CacheHandler(objc.Handler):
@@ -263,17 +706,28 @@ class S3Reader:
                                rdrange=(offset, offset + size))
 
       with osfd.OsFd(bpath, os.O_CREAT | os.O_TRUNC | os.O_WRONLY, mode=0o440) as wfd:
-        for data in stream.iter_chunks():
+        for data in stream.iter_chunks(chunk_size=_CHUNK_SIZE):
           os.write(wfd, data)
+    elif chf.use_parallel_download(self._sres.st_size):
+      return chf.parallel_download(bpath, self._sres.st_size, self._read_range)
     else:
       stream, _ = _read_object(self._client, self._bucket, self._path)
 
       with osfd.OsFd(bpath, os.O_CREAT | os.O_TRUNC | os.O_WRONLY, mode=0o440) as wfd:
-        for data in stream.iter_chunks():
+        for data in stream.iter_chunks(chunk_size=_CHUNK_SIZE):
           os.write(wfd, data)
 
     return os.path.getsize(bpath)
 
+  def _read_range(self, offset, size):
+    stream, _ = _read_object(self._client, self._bucket, self._path,
+                             rdrange=(offset, offset + size))
+
+    return stream.read()
+
+  def read_ranges(self, ranges):
+    return chf.fetch_ranges(self._read_range, ranges)
+
 
 class S3Fs(fsb.FsBase):
 
@@ -297,11 +751,15 @@ class S3Fs(fsb.FsBase):
 
     return client, purl
 
-  def _make_reader(self, client, purl):
-    sres = _stat_object(client, purl.hostname, purl.path)
+  def _make_reader(self, url, client, purl):
+    sres = self._cached_meta(
+      url, 'object',
+      functools.partial(_stat_object, client, purl.hostname, purl.path),
+      revalidate_fn=functools.partial(_not_modified, client, purl.hostname, purl.path),
+      is_missing=_is_missing)
 
     tag = S3Reader.tag(sres)
-    meta = chf.Meta(size=sres.st_size, mtime=sres.st_mtime, tag=tag)
+    meta = chf.Meta(size=sres.st_size, mtime=sres.st_mtime, tag=tag, digest=sres.digest)
     reader = S3Reader(client, purl.hostname, purl.path, sres)
 
     return reader, meta
@@ -310,25 +768,33 @@ class S3Fs(fsb.FsBase):
     src_client, src_purl = self._parse_url(src_url)
     dest_client, dest_purl = self._parse_url(dest_url)
 
-    tas.check_eq(src_purl.hostname, dest_purl.hostname,
-                 msg=f'Source and destination URL must be on the same bucket: ' \
-                 f'{src_url} vs. {dest_url}')
+    _copy_object(dest_client, src_purl.hostname, src_purl.path,
+                 dest_purl.hostname, dest_purl.path)
+    self._invalidate_meta(dest_url)
 
-    src_client.copy_object(
-      Bucket=src_purl.hostname,
-      CopySource=dict(Bucket=src_purl.hostname, Key=src_purl.path),
-      Key=dest_purl.path,
-    )
+  def server_copy(self, url, dest_fs, dest_url):
+    # Server side copies (also across buckets) need the same credentials to be
+    # able to access both source and destination.
+    if isinstance(dest_fs, S3Fs):
+      src_purl, dest_purl = uparse.urlparse(url), uparse.urlparse(dest_url)
+      if src_purl.username == dest_purl.username:
+        self._copy(url, dest_url)
+
+        return True
+
+    return False
 
   def remove(self, url):
     client, purl = self._parse_url(url)
     client.delete_object(Bucket=purl.hostname, Key=purl.path)
+    self._invalidate_meta(url)
 
   def rename(self, src_url, dest_url):
     self._copy(src_url, dest_url)
 
     src_client, src_purl = self._parse_url(src_url)
     src_client.delete_object(Bucket=src_purl.hostname, Key=src_purl.path)
+    self._invalidate_meta(src_url)
 
   def mkdir(self, url, mode=None):
     pass
@@ -343,39 +809,53 @@ class S3Fs(fsb.FsBase):
     client, purl = self._parse_url(url)
 
     _rmtree(client, purl.hostname, purl.path, ignore_errors=ignore_errors)
+    self._invalidate_meta(url)
 
   def stat(self, url):
     client, purl = self._parse_url(url)
 
-    dentry = _stat(client, purl.hostname, purl.path)
-    tas.check_is_not_none(FileNotFoundError, msg=f'Not found: {purl.hostname}:{purl.path}')
+    def fetch_stat():
+      dentry = _stat(client, purl.hostname, purl.path)
+      if dentry is None:
+        raise FileNotFoundError(f'Not found: {purl.hostname}:{purl.path}')
+
+      return dentry
 
-    return dentry
+    return self._cached_meta(url, 'stat', fetch_stat)
 
-  def list(self, url):
+  def list(self, url, with_stats=True):
     client, purl = self._parse_url(url)
 
-    return _list(client, purl.hostname, purl.path)
+    return self._cached_list(url,
+                             functools.partial(_list_dir, client, purl.hostname, purl.path))
 
   def open(self, url, mode, **kwargs):
     client, purl = self._parse_url(url)
 
     if self.read_mode(mode):
-      reader, meta = self._make_reader(client, purl)
-      cfile = self._cache_iface.open(url, meta, reader, **kwargs)
+      cfile = self._cache_iface.open_url(url,
+                                         functools.partial(self._make_reader, url, client, purl),
+                                         **kwargs)
 
       return io.TextIOWrapper(cfile) if self.text_mode(mode) else cfile
     else:
-      writeback_fn = functools.partial(self._upload_file, url)
-      if not self.truncate_mode(mode) and client.exists(purl.path):
-        url_file = self._download_file(url)
-        self.seek_stream(mode, url_file)
+      exists = not self.truncate_mode(mode) and self.exists(url)
+      # The streaming S3Writer is write-only, so it cannot serve "+" modes.
+      if exists or '+' in mode:
+        writeback_fn = functools.partial(self._upload_file, url)
+        if exists:
+          url_file = self._download_file(url)
+          self.seek_stream(mode, url_file)
+        else:
+          url_file = tempfile.TemporaryFile()
+
+        wfile = wbf.WritebackFile(url_file, writeback_fn)
       else:
-        url_file = tempfile.TemporaryFile()
-
-      wbfile = wbf.WritebackFile(url_file, writeback_fn)
+        wfile = S3Writer(client, purl.hostname, purl.path,
+                         part_size=kwargs.get('part_size'),
+                         close_fn=functools.partial(self._invalidate_meta, url))
 
-      return io.TextIOWrapper(wbfile) if self.text_mode(mode) else wbfile
+      return io.TextIOWrapper(wfile) if self.text_mode(mode) else wfile
 
   def _upload_file(self, url, stream):
     stream.seek(0)
@@ -392,17 +872,18 @@ class S3Fs(fsb.FsBase):
     client, purl = self._parse_url(url)
 
     _write_object(client, purl.hostname, purl.path, stream)
+    self._invalidate_meta(url)
 
   def get_file(self, url):
     client, purl = self._parse_url(url)
 
     stream, _ = _read_object(client, purl.hostname, purl.path)
-    for data in stream.iter_chunks():
+    for data in stream.iter_chunks(chunk_size=_CHUNK_SIZE):
       yield data
 
   def as_local(self, url, **kwargs):
     client, purl = self._parse_url(url)
-    reader, meta = self._make_reader(client, purl)
+    reader, meta = self._make_reader(url, client, purl)
 
     return self._cache_iface.as_local(url, meta, reader, **kwargs)
 
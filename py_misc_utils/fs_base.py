@@ -1,16 +1,237 @@
 import abc
 import collections
 import os
+import queue
 import stat as st
+import threading
+import time
 
+from . import executor as xe
+from . import global_namespace as gns
 
+
+# The digest, when available, is the hex MD5 of the content, while the etag is an
+# opaque identifier which is not necessarily derived from the content.
 DirEntry = collections.namedtuple(
   'DirEntry',
-  'name, st_mode, st_size, st_ctime, st_mtime, path, etag',
-  defaults=(None, None)
+  'name, st_mode, st_size, st_ctime, st_mtime, path, etag, digest',
+  defaults=(None, None, None)
 )
 
 
+_MetaEntry = collections.namedtuple('MetaEntry', 'value, error, expires')
+_IndexNode = collections.namedtuple('IndexNode', 'keys, children')
+
+def _index_url(url):
+  return url.rstrip('/') or url
+
+
+class MetaCache:
+
+  # Caches file system metadata (stat results, listings, HTTP HEAD responses, ...)
+  # for a limited time (ttl), including negative results (neg_ttl), which are either
+  # None values, or errors for which the is_missing() callback returns True.
+  # Once an entry expires, and if a revalidate_fn() is provided, it is called with
+  # the cached value (typically to issue a conditional request on the ETag) and if
+  # it returns True the entry is refreshed without fetching it again.
+  # Caching is disabled by default, as changes made by other processes would not
+  # be seen until the entries expire (GFS_META_TTL and GFS_META_NEGTTL enable it).
+  # Cached keys are indexed by file system and URL path components, so that the
+  # invalidation of a URL only visits the entries it affects.
+
+  def __init__(self, ttl=None, neg_ttl=None, max_size=None):
+    self._ttl = float(os.getenv('GFS_META_TTL', 0)) if ttl is None else ttl
+    self._neg_ttl = float(os.getenv('GFS_META_NEGTTL', 0)) if neg_ttl is None else neg_ttl
+    self._max_size = max_size or int(os.getenv('GFS_META_CACHE_SIZE', 100000))
+    self._lock = threading.Lock()
+    self._cache = collections.OrderedDict()
+    self._nodes = dict()
+
+  def _index_add(self, key):
+    # Must be called with the lock held.
+    fsid, _, url = key
+    node_url, child = _index_url(url), None
+    while True:
+      node = self._nodes.get((fsid, node_url))
+      created = node is None
+      if created:
+        node = self._nodes[(fsid, node_url)] = _IndexNode(keys=set(), children=set())
+      if child is None:
+        node.keys.add(key)
+      else:
+        node.children.add(child)
+
+      parent = os.path.dirname(node_url)
+      if not created or parent == node_url:
+        break
+      child, node_url = node_url, parent
+
+  def _index_prune(self, fsid, node_url):
+    # Must be called with the lock held.
+    while True:
+      node = self._nodes.get((fsid, node_url))
+      if node is None or node.keys or node.children:
+        break
+
+      self._nodes.pop((fsid, node_url))
+      parent = os.path.dirname(node_url)
+      if parent == node_url:
+        break
+      if (pnode := self._nodes.get((fsid, parent))) is not None:
+        pnode.children.discard(node_url)
+      node_url = parent
+
+  def _index_remove(self, key):
+    # Must be called with the lock held.
+    fsid, _, url = key
+    node_url = _index_url(url)
+    if (node := self._nodes.get((fsid, node_url))) is not None:
+      node.keys.discard(key)
+      self._index_prune(fsid, node_url)
+
+  def _store(self, key, value=None, error=None):
+    ttl = self._ttl if value is not None else self._neg_ttl
+    if ttl > 0:
+      with self._lock:
+        self._cache[key] = _MetaEntry(value=value, error=error, expires=time.time() + ttl)
+        self._cache.move_to_end(key)
+        self._index_add(key)
+        while len(self._cache) > self._max_size:
+          xkey, _ = self._cache.popitem(last=False)
+          self._index_remove(xkey)
+
+  def lookup(self, key):
+    # Returns the cached value, if present and not expired, or None.
+    with self._lock:
+      entry = self._cache.get(key)
+
+    if entry is not None and time.time() < entry.expires:
+      if entry.error is not None:
+        raise entry.error.with_traceback(None)
+
+      return entry.value
+
+  def put(self, key, value):
+    self._store(key, value=value)
+
+  def get(self, key, fetch_fn, revalidate_fn=None, is_missing=None):
+    with self._lock:
+      entry = self._cache.get(key)
+
+    if entry is not None:
+      if time.time() < entry.expires:
+        if entry.error is not None:
+          raise entry.error.with_traceback(None)
+
+        return entry.value
+
+      if entry.value is not None and revalidate_fn is not None:
+        try:
+          if revalidate_fn(entry.value):
+            self._store(key, value=entry.value)
+
+            return entry.value
+        except Exception:
+          pass
+
+    try:
+      value = fetch_fn()
+    except Exception as ex:
+      missing = is_missing(ex) if is_missing is not None else isinstance(ex, FileNotFoundError)
+      if missing:
+        self._store(key, error=ex)
+      raise
+
+    self._store(key, value=value)
+
+    return value
+
+  def invalidate(self, fsid, url):
+    # Drops the entries for the URL, the ones below it, and the ones for all its
+    # parents (whose listings, and aggregated directory stats, changed).
+    url = _index_url(url)
+    with self._lock:
+      stack = [url]
+      while stack:
+        node_url = stack.pop()
+        if (node := self._nodes.pop((fsid, node_url), None)) is not None:
+          for key in node.keys:
+            self._cache.pop(key, None)
+          stack.extend(node.children)
+
+      parent = os.path.dirname(url)
+      if (node := self._nodes.get((fsid, parent))) is not None:
+        node.children.discard(url)
+
+      node_url = url
+      while (parent := os.path.dirname(node_url)) != node_url:
+        if (node := self._nodes.get((fsid, parent))) is not None:
+          for key in node.keys:
+            self._cache.pop(key, None)
+          node.keys.clear()
+        node_url = parent
+
+      self._index_prune(fsid, os.path.dirname(url))
+
+  def clear(self):
+    with self._lock:
+      self._cache.clear()
+      self._nodes.clear()
+
+
+_META_CACHE = gns.Var(f'{__name__}.META_CACHE',
+                      fork_init=True,
+                      defval=lambda: MetaCache())
+
+def meta_cache():
+  return gns.get(_META_CACHE)
+
+
+_COPY_DEPTH = int(os.getenv('GFS_COPY_DEPTH', 4))
+_END = object()
+
+def _pipeline_reader(data_gen, dqueue, stop):
+  def put(item):
+    while not stop.is_set():
+      try:
+        dqueue.put(item, timeout=0.5)
+
+        return True
+      except queue.Full:
+        pass
+
+  try:
+    for data in data_gen:
+      if not put(data):
+        break
+  except Exception as ex:
+    put(ex)
+  finally:
+    put(_END)
+
+
+def pipelined(data_gen, depth=None):
+  # Runs the data generator from a separate thread, so that reading from the source
+  # overlaps with the consumer writing to the destination. At most depth chunks
+  # are buffered.
+  dqueue = queue.Queue(maxsize=depth or _COPY_DEPTH)
+  stop = threading.Event()
+  reader = threading.Thread(target=_pipeline_reader, args=(data_gen, dqueue, stop),
+                            daemon=True)
+  reader.start()
+  try:
+    while (data := dqueue.get()) is not _END:
+      if isinstance(data, Exception):
+        raise data
+
+      yield data
+  finally:
+    stop.set()
+
+
+_WALK_WORKERS = int(os.getenv('GFS_WALK_WORKERS', 16))
+_LIST_CACHE_MAXSIZE = int(os.getenv('GFS_LIST_CACHE_MAXSIZE', 10000))
+
 class FsBase(abc.ABC):
 
   def __init__(self, cache_iface=None, **kwargs):
@@ -45,6 +266,33 @@ class FsBase(abc.ABC):
   def norm_url(self, url):
     return url
 
+  def _cached_meta(self, url, kind, fetch_fn, revalidate_fn=None, is_missing=None):
+    return meta_cache().get((self.ID, kind, url), fetch_fn,
+                            revalidate_fn=revalidate_fn,
+                            is_missing=is_missing)
+
+  def _cached_list(self, url, list_fn):
+    # Listings are streamed as they arrive, and only the ones not bigger than
+    # _LIST_CACHE_MAXSIZE entries are stored within the metadata cache.
+    key = (self.ID, 'list', url)
+    if (dentries := meta_cache().lookup(key)) is not None:
+      yield from dentries
+    else:
+      dentries = []
+      for de in list_fn():
+        if dentries is not None:
+          dentries.append(de)
+          if len(dentries) > _LIST_CACHE_MAXSIZE:
+            dentries = None
+
+        yield de
+
+      if dentries is not None:
+        meta_cache().put(key, tuple(dentries))
+
+  def _invalidate_meta(self, url):
+    meta_cache().invalidate(self.ID, url)
+
   def exists(self, url):
     try:
       self.stat(url)
@@ -69,8 +317,55 @@ class FsBase(abc.ABC):
     except:
       return False
 
-  def copyfile(self, url, dest_fs, dest_url):
-    dest_fs.put_file(dest_url, self.get_file(url))
+  def _walk_url(self, url, de):
+    return os.path.join(url, de.name)
+
+  def _is_walk_dir(self, url, de):
+    return de.st_mode is not None and st.S_ISDIR(de.st_mode)
+
+  def walk(self, url, with_stats=None, max_depth=None, workers=None, executor=None):
+    # Streams (URL, DirEntry) tuples for all the entries below url, in breadth
+    # first order, while listing up to workers directories concurrently.
+    workers = workers or _WALK_WORKERS
+    executor = executor or xe.common_executor()
+
+    def list_dir(dir_url):
+      # Errors are handed over to the consumer (ie, FileNotFoundError for a missing
+      # url), instead of being logged as task failures by the executor.
+      try:
+        return tuple(self.list(dir_url, with_stats=with_stats or False))
+      except Exception as ex:
+        return ex
+
+    pending = collections.deque([(url, 1)])
+    inflight = collections.deque()
+    while pending or inflight:
+      while pending and len(inflight) < workers:
+        dir_url, depth = pending.popleft()
+        inflight.append((dir_url, depth, executor.submit_result(list_dir, dir_url)))
+
+      dir_url, depth, aresult = inflight.popleft()
+      dentries = aresult.wait()
+      if isinstance(dentries, Exception):
+        raise dentries
+
+      for de in dentries:
+        de_url = self._walk_url(dir_url, de)
+
+        yield de_url, de
+
+        if (max_depth is None or depth < max_depth) and self._is_walk_dir(dir_url, de):
+          pending.append((de_url, depth + 1))
+
+  def server_copy(self, url, dest_fs, dest_url):
+    # File systems able to copy data without it going through the client (like
+    # same bucket copies in object stores) override this and return True when the
+    # copy has been done.
+    return False
+
+  def copyfile(self, url, dest_fs, dest_url, depth=None):
+    if not self.server_copy(url, dest_fs, dest_url):
+      dest_fs.put_file(dest_url, pipelined(self.get_file(url), depth=depth))
 
   @abc.abstractmethod
   def stat(self, url):
@@ -108,7 +403,7 @@ class FsBase(abc.ABC):
     ...
 
   @abc.abstractmethod
-  def list(self, url):
+  def list(self, url, with_stats=True):
     ...
 
   @abc.abstractmethod
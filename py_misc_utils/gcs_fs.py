@@ -1,6 +1,8 @@
+import base64
 import collections
 import os
 import stat as st
+import threading
 
 import google.cloud.storage as gcs
 
@@ -12,11 +14,26 @@ from . import fs_base as fsb
 # https://cloud.google.com/python/docs/reference/storage/1.44.0/client
 # https://cloud.google.com/python/docs/reference/storage/1.44.0/blobs#google.cloud.storage.blob.Blob
 
+def _md5_digest(blob):
+  # Composite objects have no MD5 (only a CRC32C, which is too weak to identify
+  # the content).
+  if blob.md5_hash:
+    return base64.b64decode(blob.md5_hash).hex()
+
+
+_MAX_FETCHES = int(os.getenv('GFS_GCS_MAX_FETCHES', 16))
+
 class GcsFs:
 
-  def __init__(self, bucket):
+  def __init__(self, bucket, max_fetches=None):
     self.bucket = bucket
     self._client = gcs.Client()
+    self._bucket = self._client.bucket(bucket)
+    # Bounds the number of concurrent downloads hitting the bucket.
+    self._fetch_slots = threading.BoundedSemaphore(max_fetches or _MAX_FETCHES)
+
+  def blob(self, path):
+    return self._bucket.blob(path)
 
   def _blob_stat(self, blob, base_path=None):
     name = blob.name
@@ -28,10 +45,10 @@ class GcsFs:
       if spos > 0:
         name = name[: spos]
         mode = st.S_IFDIR
-        size, etag = 0, None
+        size, etag, digest = 0, None, None
       else:
         mode = st.S_IFREG
-        size, etag = blob.size, blob.etag
+        size, etag, digest = blob.size, blob.etag, _md5_digest(blob)
 
       path = base_path + name
     else:
@@ -40,11 +57,12 @@ class GcsFs:
         name = name[spos + 1:]
       mode = st.S_IFREG
       path = blob.name
-      size, etag = blob.size, blob.etag
+      size, etag, digest = blob.size, blob.etag, _md5_digest(blob)
 
     return fsb.DirEntry(name=name,
                         path=path,
                         etag=etag,
+                        digest=digest,
                         st_mode=mode,
                         st_size=size,
                         st_ctime=blob.time_created.timestamp(),
@@ -76,23 +94,41 @@ class GcsFs:
     for name, dentry in sorted_dentries:
       yield dentry
 
+  def scandir(self, path):
+    # Lists a single directory level (unlike listdir(), which walks the whole
+    # subtree to compute the directories times), streaming the entries page by page.
+    npath = self._norm_path(path)
+
+    blobs = self._client.list_blobs(self.bucket, prefix=npath, delimiter='/')
+    for page in blobs.pages:
+      for prefix in page.prefixes:
+        name = prefix[len(npath):].rstrip('/')
+        yield fsb.DirEntry(name=name,
+                           path=npath + name,
+                           st_mode=st.S_IFDIR,
+                           st_size=0,
+                           st_ctime=None,
+                           st_mtime=None)
+
+      for blob in page:
+        # Directory marker objects (whose name is the prefix itself) have no name.
+        if (dentry := self._blob_stat(blob, base_path=npath)) is not None and dentry.name:
+          yield dentry
+
   def open(self, path, mode='rb'):
-    bucket = self._client.bucket(self.bucket)
-    blob = bucket.blob(path)
+    blob = self.blob(path)
 
     return blob.open(mode)
 
   def upload(self, path, source):
-    bucket = self._client.bucket(self.bucket)
-    blob = bucket.blob(path)
+    blob = self.blob(path)
 
     with blob.open('wb') as fd:
       for data in source:
         fd.write(data)
 
-  def download(self, path, chunk_size=32 * 1024**2):
-    bucket = self._client.bucket(self.bucket)
-    blob = bucket.blob(path)
+  def download(self, path, chunk_size=32 * 1024**2, blob=None):
+    blob = blob or self.blob(path)
 
     with blob.open('rb') as fd:
       while True:
@@ -102,21 +138,31 @@ class GcsFs:
         if chunk_size > len(data):
           break
 
-  def pread(self, path, offset, size):
-    bucket = self._client.bucket(self.bucket)
-    blob = bucket.blob(path)
+  def pread(self, path, offset, size, blob=None):
+    blob = blob or self.blob(path)
+
+    with self._fetch_slots:
+      return blob.download_as_bytes(start=offset, end=offset + size - 1, raw_download=True)
 
-    return blob.download_as_bytes(start=offset, end=offset + size - 1, raw_download=True)
+  def download_to(self, path, fobj, offset=None, size=None, blob=None):
+    # Streams the (range of the) object into fobj, without materializing it in
+    # memory, as the data is written as it gets received.
+    blob = blob or self.blob(path)
+    end = offset + size - 1 if size is not None else None
+    # Object checksums cannot be verified on partial reads.
+    checksum = 'md5' if offset is None else None
+
+    with self._fetch_slots:
+      blob.download_to_file(fobj, start=offset, end=end, raw_download=True,
+                            checksum=checksum)
 
   def exists(self, path):
-    bucket = self._client.bucket(self.bucket)
-    blob = bucket.blob(path)
+    blob = self.blob(path)
 
     return blob.exists()
 
   def stat(self, path):
-    bucket = self._client.bucket(self.bucket)
-    blob = bucket.get_blob(path)
+    blob = self._bucket.get_blob(path)
     if blob is not None:
       return self._blob_stat(blob)
 
@@ -139,16 +185,12 @@ class GcsFs:
                           st_mtime=mtime)
 
   def remove(self, path):
-    bucket = self._client.bucket(self.bucket)
-    blob = bucket.blob(path)
+    blob = self.blob(path)
     blob.delete()
 
   def rename(self, src_path, dest_path):
-    bucket = self._client.bucket(self.bucket)
-    src_blob = bucket.blob(src_path)
-
-    bucket.copy_blob(src_blob, bucket, dest_path)
-    bucket.delete_blob(src_path)
+    self.copy(src_path, dest_path)
+    self._bucket.delete_blob(src_path)
 
   def rmtree(self, path, ignore_errors=None):
     npath = self._norm_path(path)
@@ -161,9 +203,13 @@ class GcsFs:
         if ignore_errors in (None, False):
           raise
 
-  def copy(self, src_path, dest_path):
-    bucket = self._client.bucket(self.bucket)
-    src_blob = bucket.blob(src_path)
+  def copy(self, src_path, dest_path, dest_bucket=None):
+    # Rewrites can copy objects of any size (also across buckets and locations),
+    # possibly taking multiple calls.
+    src_blob = self.blob(src_path)
+    dest_blob = self._client.bucket(dest_bucket or self.bucket).blob(dest_path)
 
-    bucket.copy_blob(src_blob, bucket, dest_path)
+    token, _, _ = dest_blob.rewrite(src_blob)
+    while token is not None:
+      token, _, _ = dest_blob.rewrite(src_blob, token=token)
 
@@ -6,6 +6,7 @@ import pkgutil
 import re
 import shutil
 import sys
+import threading
 import urllib.parse as uparse
 
 from . import alog
@@ -13,6 +14,7 @@ from . import assert_checks as tas
 from . import cached_file as chf
 from . import context_managers as cm
 from . import fs_utils as fsu
+from . import global_namespace as gns
 from . import mirror_from as mrf
 from . import run_once as ro
 
@@ -206,6 +208,18 @@ def replace(src_path, dest_path, src_fs=None, dest_fs=None):
     src.fs.remove(src.path)
 
 
+def sync(src_path, dest_path, **kwargs):
+  from . import gfs_sync
+
+  return gfs_sync.sync(src_path, dest_path, **kwargs)
+
+
+def copytree(src_path, dest_path, **kwargs):
+  from . import gfs_sync
+
+  return gfs_sync.copytree(src_path, dest_path, **kwargs)
+
+
 def remove(path):
   fs, fpath = resolve_fs(path)
   fs.remove(fpath)
@@ -270,7 +284,7 @@ class RegexMatcher:
 def enumerate_files(path, matcher=None, return_stats=False):
   fs, fpath = resolve_fs(path)
 
-  for de in fs.list(fpath):
+  for de in fs.list(fpath, with_stats=return_stats):
     if matcher is None or matcher(de.name):
       if return_stats:
         yield de.name, de
@@ -278,6 +292,72 @@ def enumerate_files(path, matcher=None, return_stats=False):
         yield de.name
 
 
+def walk(path, with_stats=False, max_depth=None, workers=None):
+  # Yields (URL, DirEntry) tuples for all the entries below path, whose directories
+  # are listed concurrently. Unless with_stats is True, only the entry type is
+  # guaranteed to be set, as file systems are free to skip fetching the other
+  # stat fields (which can be queried with stat() when needed).
+  fs, fpath = resolve_fs(path)
+
+  return fs.walk(fpath, with_stats=with_stats, max_depth=max_depth, workers=workers)
+
+
+def _glob_part(part):
+  rex, i = [], 0
+  while i < len(part):
+    c = part[i]
+    if c == '*':
+      rex.append('[^/]*')
+    elif c == '?':
+      rex.append('[^/]')
+    elif c == '[' and (j := part.find(']', i + 2)) > 0:
+      cset = part[i + 1: j]
+      if cset.startswith('!'):
+        cset = '^' + cset[1:]
+      rex.append(f'[{cset}]')
+      i = j
+    else:
+      rex.append(re.escape(c))
+    i += 1
+
+  return ''.join(rex)
+
+
+def _glob_regex(parts):
+  rex = []
+  for i, part in enumerate(parts):
+    if part == '**':
+      # A "**" matches zero or more directories.
+      rex.append('.*' if i + 1 == len(parts) else '(.*/)?')
+    else:
+      rex.append(_glob_part(part) + ('/' if i + 1 < len(parts) else ''))
+
+  return re.compile(''.join(rex))
+
+
+def glob(pattern, with_stats=False, workers=None):
+  # Yields the URLs matching the pattern (or (URL, DirEntry) tuples if with_stats
+  # is True), where "*", "?" and "[...]" match within a path component, and "**"
+  # matches across any number of them.
+  parts = pattern.split('/')
+  magic = [i for i, part in enumerate(parts) if re.search(r'[*?\[]', part)]
+  if not magic:
+    if exists(pattern):
+      yield (pattern, stat(pattern)) if with_stats else pattern
+    return
+
+  base, parts = '/'.join(parts[: magic[0]]), parts[magic[0]:]
+  rex = _glob_regex(parts)
+  max_depth = None if '**' in parts else len(parts)
+
+  fs, fpath = resolve_fs(base or '.')
+  for url, de in fs.walk(fpath, with_stats=with_stats, max_depth=max_depth,
+                         workers=workers):
+    rpath = url[len(fpath):].strip('/')
+    if rex.fullmatch(rpath):
+      yield (url, de) if with_stats else url
+
+
 def normpath(path):
   _, fpath = resolve_fs(path)
 
@@ -356,16 +436,83 @@ def get_proto_fs(proto, **kwargs):
   return cls(**kwargs)
 
 
+def _freeze(value):
+  if isinstance(value, dict):
+    return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+  elif isinstance(value, (list, tuple)):
+    return tuple(_freeze(v) for v in value)
+
+  return value
+
+
+class _FsCache:
+
+  def __init__(self, max_size):
+    self._max_size = max_size
+    self._lock = threading.Lock()
+    self._cache = collections.OrderedDict()
+
+  def get(self, key, create_fn):
+    with self._lock:
+      fs = self._cache.get(key)
+      if fs is not None:
+        self._cache.move_to_end(key)
+
+        return fs
+
+    fs = create_fn()
+
+    with self._lock:
+      self._cache[key] = fs
+      while len(self._cache) > self._max_size:
+        self._cache.popitem(last=False)
+
+    return fs
+
+  def clear(self):
+    with self._lock:
+      self._cache.clear()
+
+
+_FS_CACHE = gns.Var(f'{__name__}.FS_CACHE',
+                    fork_init=True,
+                    defval=lambda: _FsCache(int(os.getenv('GFS_FSCACHE_SIZE', 256))))
+
+def clear_fs_cache():
+  gns.get(_FS_CACHE).clear()
+
+
+def _fs_cache_key(proto, path, cachedir, cache_iface, kwargs):
+  # The network location includes the credentials (if any) in the URL.
+  netloc = uparse.urlparse(path).netloc if has_proto(path) else ''
+  try:
+    key = (proto, netloc, cachedir, id(cache_iface) if cache_iface is not None else None,
+           _freeze(kwargs))
+    hash(key)
+
+    return key
+  except TypeError:
+    pass
+
+
 def resolve_fs(path, **kwargs):
   proto = get_proto(path)
 
   cachedir = chf.get_cache_dir(kwargs.pop('cache_dir', cache_dir()))
-
   cache_iface = kwargs.pop('cache_iface', None)
-  if cache_iface is None:
-    cache_iface = chf.CacheInterface(cachedir)
 
-  fs = get_proto_fs(proto, cache_iface=cache_iface, cache_dir=cachedir, **kwargs)
+  def create_fs():
+    fs_cache_iface = cache_iface
+    if fs_cache_iface is None:
+      fs_cache_iface = chf.CacheInterface(cachedir)
+
+    return get_proto_fs(proto, cache_iface=fs_cache_iface, cache_dir=cachedir, **kwargs)
+
+  # File systems objects are reused across calls with the same arguments (which
+  # allows for example to reuse HTTP sessions and their connection pools), unless
+  # the arguments are not hashable.
+  key = _fs_cache_key(proto, path, cachedir, cache_iface, kwargs)
+  fs = gns.get(_FS_CACHE).get(key, create_fs) if key is not None else create_fs()
 
   return fs, fs.norm_url(path)
 
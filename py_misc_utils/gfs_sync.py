@@ -0,0 +1,269 @@
+import collections
+import hashlib
+import json
+import os
+import stat as st
+import threading
+import time
+
+from . import alog
+from . import assert_checks as tas
+from . import executor as xe
+from . import fs_utils as fsu
+from . import gfs
+
+
+_WORKERS = int(os.getenv('GFS_SYNC_WORKERS', 8))
+_FILE_DEPTH = int(os.getenv('GFS_SYNC_FILE_DEPTH', 4))
+_REPORT_PERIOD = float(os.getenv('GFS_SYNC_REPORT_PERIOD', 10))
+
+_COMPARE_MODES = ('size', 'mtime', 'etag', 'always')
+
+SyncResult = collections.namedtuple(
+  'SyncResult',
+  'copied, skipped, removed, failed, nbytes, elapsed, throughput'
+)
+
+
+def _journal_path(src_path, dest_path):
+  jid = hashlib.sha1(f'{src_path}\n{dest_path}'.encode()).hexdigest()
+
+  return os.path.join(gfs.cache_dir(), 'gfs_sync', f'{jid}.journal')
+
+
+def _signature(de):
+  return f'{de.st_size}:{de.digest or de.etag or de.st_mtime}'
+
+
+class _Journal:
+
+  # Records the files whose transfer completed, together with the signature of
+  # the source they have been copied from, so that an interrupted sync can skip
+  # them when resumed (without relying on the destination listing).
+
+  def __init__(self, path):
+    self.path = path
+    self._lock = threading.Lock()
+    self._done = dict()
+    if os.path.exists(path):
+      with open(path, mode='r') as jfd:
+        for line in jfd:
+          try:
+            entry = json.loads(line)
+            self._done[entry['path']] = entry['sig']
+          except ValueError:
+            # A partially written record from an interrupted run.
+            pass
+
+      alog.debug(f'Loaded {len(self._done)} completed transfers from {path}')
+    else:
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    self._fd = open(path, mode='a')
+
+  def is_done(self, rpath, sig):
+    return self._done.get(rpath) == sig
+
+  def add(self, rpath, sig):
+    with self._lock:
+      self._fd.write(json.dumps(dict(path=rpath, sig=sig)) + '\n')
+      self._fd.flush()
+
+  def close(self, completed):
+    self._fd.close()
+    if completed:
+      fsu.maybe_remove(self.path)
+
+
+def _needs_copy(sde, dde, compare):
+  if dde is None or compare == 'always' or sde.st_size != dde.st_size:
+    return True
+  if compare == 'size':
+    return False
+  # ETags are opaque, and differ among backends for the same content, so only the
+  # content digests can be compared (falling back to the modification times).
+  if compare == 'etag' and sde.digest and dde.digest:
+    return sde.digest != dde.digest
+
+  return sde.st_mtime is None or dde.st_mtime is None or dde.st_mtime < sde.st_mtime
+
+
+def _rel_path(base, url):
+  return url[len(base):].strip('/')
+
+
+def _is_file(de):
+  return de.st_mode is not None and st.S_ISREG(de.st_mode)
+
+
+def _list_files(fs, path, workers):
+  for url, de in fs.walk(path, with_stats=True, workers=workers):
+    if _is_file(de):
+      yield _rel_path(path, url), url, de
+
+
+class _Stats:
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.start = time.time()
+    self.copied = self.skipped = self.removed = self.failed = self.nbytes = 0
+    self.reported = self.start
+
+  def add(self, **kwargs):
+    with self.lock:
+      for name, value in kwargs.items():
+        setattr(self, name, getattr(self, name) + value)
+
+  def maybe_report(self):
+    # Called from both the listing loop and the transfer workers.
+    with self.lock:
+      now = time.time()
+      if now - self.reported < _REPORT_PERIOD:
+        return
+
+      self.reported = now
+      elapsed = now - self.start
+      alog.info(f'Sync progress: {self.copied} copied, {self.skipped} skipped, ' \
+                f'{self.failed} failed, {self.nbytes / 1024**2:.1f} MB in ' \
+                f'{elapsed:.1f}s ({self.nbytes / 1024**2 / elapsed:.1f} MB/s)')
+
+  def result(self):
+    elapsed = time.time() - self.start
+
+    return SyncResult(copied=self.copied,
+                      skipped=self.skipped,
+                      removed=self.removed,
+                      failed=self.failed,
+                      nbytes=self.nbytes,
+                      elapsed=elapsed,
+                      throughput=self.nbytes / elapsed if elapsed > 0 else 0)
+
+
+def sync(src_path, dest_path,
+         compare=None,
+         delete=False,
+         workers=None,
+         file_depth=None,
+         journal=None,
+         ignore_errors=False,
+         dry_run=False):
+  # Makes dest_path a copy of the src_path tree, transferring only the files which
+  # differ according to the compare mode (see _needs_copy()). Up to workers files
+  # are transferred concurrently, each with at most file_depth chunks in flight
+  # between source and destination. Completed transfers are recorded in a journal
+  # (journal=False disables it) which is dropped once the sync completes.
+  compare = compare or 'mtime'
+  tas.check(compare in _COMPARE_MODES, msg=f'Invalid compare mode: {compare}')
+
+  workers = workers or _WORKERS
+  file_depth = file_depth or _FILE_DEPTH
+
+  src_fs, src_fpath = gfs.resolve_fs(src_path)
+  dest_fs, dest_fpath = gfs.resolve_fs(dest_path)
+
+  # A missing destination is detected by the listing itself, as the stat of a
+  # directory on object stores lists its whole subtree.
+  dest_files = dict()
+  try:
+    for rpath, url, de in _list_files(dest_fs, dest_fpath, workers):
+      dest_files[rpath] = de
+  except FileNotFoundError:
+    pass
+
+  if journal is not False and not dry_run:
+    jrn = _Journal(journal or _journal_path(src_fpath, dest_fpath))
+  else:
+    jrn = None
+
+  stats = _Stats()
+  errors = []
+  dirs_lock = threading.Lock()
+  created_dirs = set()
+
+  def make_parent(dest_url):
+    parent = os.path.dirname(dest_url)
+    with dirs_lock:
+      if parent not in created_dirs:
+        dest_fs.makedirs(parent, exist_ok=True)
+        created_dirs.add(parent)
+
+  def transfer(rpath, src_url, sde):
+    dest_url = os.path.join(dest_fpath, rpath)
+    try:
+      make_parent(dest_url)
+      src_fs.copyfile(src_url, dest_fs, dest_url, depth=file_depth)
+
+      dde = dest_fs.stat(dest_url)
+      if sde.st_size is not None:
+        tas.check_eq(dde.st_size, sde.st_size,
+                     msg=f'Size mismatch after copying {src_url} to {dest_url}')
+
+      if jrn is not None:
+        jrn.add(rpath, _signature(sde))
+      stats.add(copied=1, nbytes=sde.st_size or dde.st_size or 0)
+    except Exception as ex:
+      alog.warning(f'Failed to copy {src_url} to {dest_url}: {ex}')
+      stats.add(failed=1)
+      with stats.lock:
+        errors.append(ex)
+
+  executor = xe.Executor(max_threads=workers, name_prefix='GfsSync')
+  slots = threading.Semaphore(2 * workers)
+
+  def run_transfer(*args):
+    try:
+      transfer(*args)
+      stats.maybe_report()
+    finally:
+      slots.release()
+
+  src_files = set()
+  try:
+    for rpath, src_url, sde in _list_files(src_fs, src_fpath, workers):
+      src_files.add(rpath)
+      if ((jrn is not None and jrn.is_done(rpath, _signature(sde))) or
+          not _needs_copy(sde, dest_files.get(rpath), compare)):
+        stats.add(skipped=1)
+      elif dry_run:
+        alog.info(f'Would copy {src_url} to {os.path.join(dest_fpath, rpath)}')
+        stats.add(copied=1, nbytes=sde.st_size or 0)
+      else:
+        slots.acquire()
+        executor.submit(run_transfer, rpath, src_url, sde)
+
+      stats.maybe_report()
+  finally:
+    executor.shutdown()
+
+  if delete and not errors:
+    for rpath in sorted(set(dest_files) - src_files):
+      dest_url = os.path.join(dest_fpath, rpath)
+      if dry_run:
+        alog.info(f'Would remove {dest_url}')
+      else:
+        dest_fs.remove(dest_url)
+      stats.add(removed=1)
+
+  if jrn is not None:
+    jrn.close(not errors)
+
+  result = stats.result()
+  alog.info(f'Synced {src_path} to {dest_path}: {result.copied} copied, ' \
+            f'{result.skipped} skipped, {result.removed} removed, {result.failed} ' \
+            f'failed, {result.nbytes / 1024**2:.1f} MB in {result.elapsed:.1f}s ' \
+            f'({result.throughput / 1024**2:.1f} MB/s)')
+
+  if errors and not ignore_errors:
+    alog.xraise(RuntimeError, f'Failed to copy {len(errors)} files from {src_path} ' \
+                f'to {dest_path} (re-run to resume): {errors[0]}')
+
+  return result
+
+
+def copytree(src_path, dest_path, **kwargs):
+  # Unlike sync(), all the source files are copied (although an interrupted
+  # copytree() still resumes from its journal).
+  kwargs.setdefault('compare', 'always')
+
+  return sync(src_path, dest_path, **kwargs)
@@ -85,6 +85,27 @@ class IterFile:
   def read1(self, size=-1):
     return self.read(size=size)
 
+  def readinto(self, b):
+    mv = memoryview(b).cast('B')
+    rsize = min(len(mv), self._size - self._offset)
+
+    pos = 0
+    while pos < rsize:
+      boffset = self._ensure_buffer(self._offset)
+
+      csize = min(rsize - pos, len(self._block) - boffset)
+      mv[pos: pos + csize] = self._block[boffset: boffset + csize]
+      self._offset += csize
+      pos += csize
+
+    return pos
+
+  def readinto1(self, b):
+    return self.readinto(b)
+
+  def readall(self):
+    return self.read()
+
   def peek(self, size=0):
     if size > 0:
       boffset = self._ensure_buffer(self._offset)
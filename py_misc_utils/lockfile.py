@@ -1,9 +1,17 @@
+import errno
 import hashlib
 import os
 import psutil
+import struct
+import sys
 import time
 import yaml
 
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
 from . import alog
 from . import assert_checks as tas
 from . import fs_utils as fsu
@@ -162,3 +170,122 @@ class LockFile:
 
     return False
 
+
+
+_FLOCK_POLL_TIMEOUT = float(os.getenv('LOCKF_FLOCK_POLLTIMEO', 0.05))
+_FLOCK_FILES = int(os.getenv('LOCKF_FLOCK_FILES', 64))
+# The "struct flock" layout, where the trailing "0q" pads the size to a multiple
+# of the off_t alignment.
+_FLOCK_STRUCT = struct.Struct('hhqqi0q')
+
+def _has_ofd_locks():
+  return fcntl is not None and hasattr(fcntl, 'F_OFD_SETLKW')
+
+
+def _lock_slot(name):
+  # Locks are byte ranges (at an offset given by the name hash) within a bounded
+  # set of lock files, so that lock files do not accumulate over time.
+  # Without OFD locks flock(2) locks whole files, so every name needs its own file,
+  # as nested locks whose names map to the same file would deadlock.
+  if not _has_ofd_locks():
+    return _lockfile(name) + '.flock', 0
+
+  lhash = hashlib.sha1(name.encode()).hexdigest()
+  path = os.path.join(_LOCKDIR, f'flock-{int(lhash[: 8], 16) % _FLOCK_FILES:03d}')
+
+  return path, int(lhash[8: 23], 16)
+
+
+class FLockFile:
+
+  # Kernel based lock which does not need polling when waiting for the holder to
+  # release it, and which gets automatically released when the holder process dies
+  # (as the kernel closes its file descriptors).
+  # Open file description locks (F_OFD_SETLK) are tied to the file descriptor,
+  # which is opened at every acquire, so the lock also works among threads of the
+  # same process. Where those are not available, flock(2) is used on a lock file
+  # per name (which, unlike the shared ones, accumulate over time).
+
+  def __init__(self, name, acquire_timeout=None, check_timeout=None):
+    self._name = name
+    self._lockfile, self._offset = _lock_slot(name)
+    self._fd = None
+
+  def _lock(self, fd, shared, wait):
+    if _has_ofd_locks():
+      ltype = fcntl.F_RDLCK if shared else fcntl.F_WRLCK
+      lock = _FLOCK_STRUCT.pack(ltype, os.SEEK_SET, self._offset, 1, 0)
+      try:
+        fcntl.fcntl(fd, fcntl.F_OFD_SETLKW if wait else fcntl.F_OFD_SETLK, lock)
+      except OSError as ex:
+        if ex.errno in (errno.EAGAIN, errno.EACCES):
+          raise BlockingIOError(ex.errno, ex.strerror)
+        raise
+    else:
+      op = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+      fcntl.flock(fd, op if wait else op | fcntl.LOCK_NB)
+
+  def acquire(self, timeout=None, shared=False):
+    fd = os.open(self._lockfile, os.O_RDWR | os.O_CREAT, mode=0o666)
+    try:
+      if timeout is None:
+        self._lock(fd, shared, True)
+      else:
+        quit_time = time.time() + timeout
+        while True:
+          try:
+            self._lock(fd, shared, False)
+            break
+          except BlockingIOError:
+            if time.time() >= quit_time:
+              alog.debug(f'Giving up on lock {self._name} after {timeout} seconds')
+              os.close(fd)
+
+              return False
+
+            time.sleep(_FLOCK_POLL_TIMEOUT)
+    except:
+      os.close(fd)
+      raise
+
+    self._fd = fd
+
+    return True
+
+  def try_acquire(self, shared=False):
+    return self.acquire(timeout=0, shared=shared)
+
+  def release(self):
+    fd, self._fd = self._fd, None
+    if fd is not None:
+      # Closing the file descriptor releases the lock. The lock files are shared
+      # among many locks, and never removed.
+      os.close(fd)
+
+      return True
+
+    alog.warning(f'Trying to release lock on {self._name} from pid {os.getpid()} but ' \
+                 f'the lock was not held')
+
+    return False
+
+  def __enter__(self):
+    self.acquire()
+
+    return self
+
+  def __exit__(self, *exc):
+    self.release()
+
+    return False
+
+
+_LOCK_MODE = os.getenv('LOCKF_MODE',
+                       'flock' if fcntl is not None and sys.platform.startswith('linux')
+                       else 'file')
+
+def create_lock(name, **kwargs):
+  if _LOCK_MODE == 'flock':
+    return FLockFile(name, **kwargs)
+
+  return LockFile(name, **kwargs)
@@ -105,6 +105,23 @@ class StreamedFile:
 
     return data
 
+  def _readinto(self, offset, b, adj_offset):
+    mv = memoryview(b).cast('B')
+    size = len(mv)
+    while not (self._completed or self._closed or self._size >= offset + size):
+      self._cond.wait()
+
+    to_read = min(size, self._size - offset)
+    if not self._closed and to_read > 0:
+      self._tempfile.seek(offset)
+      rsize = self._tempfile.readinto(mv[: to_read])
+      if adj_offset:
+        self._offset += rsize
+    else:
+      rsize = 0
+
+    return rsize
+
   def read(self, size=-1):
     with self._lock:
       return self._read(self._offset, size, True)
@@ -112,6 +129,16 @@ class StreamedFile:
   def read1(self, size=-1):
     return self.read(size=size)
 
+  def readinto(self, b):
+    with self._lock:
+      return self._readinto(self._offset, b, True)
+
+  def readinto1(self, b):
+    return self.readinto(b)
+
+  def readall(self):
+    return self.read()
+
   def peek(self, size=0):
     with self._lock:
       size = min(size, max(1, self._size - self._offset))
@@ -0,0 +1,182 @@
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import py_misc_utils.cached_file as chf
+import py_misc_utils.fs.file_fs as ffs
+
+
+_BLOCK_SIZE = 64 * 1024
+
+
+class _RangeReader(ffs.FileReader):
+
+  def __init__(self, path):
+    super().__init__(path)
+    self.ranges = []
+
+  def read_ranges(self, ranges):
+    self.ranges.extend(ranges)
+    with open(self._path, mode='rb') as fd:
+      return [os.pread(fd.fileno(), size, offset) for offset, size in ranges]
+
+
+class _StallingReader(ffs.FileReader):
+
+  # Writes the first part of a block only after a while (like a remote time to
+  # first byte), then stalls until released.
+  def __init__(self, path, release):
+    super().__init__(path)
+    self._release = release
+    self.downloads = 0
+
+  def read_block(self, bpath, offset, size):
+    self.downloads += 1
+    time.sleep(0.2)
+    with open(bpath, mode='wb') as fd, open(self._path, mode='rb') as sfd:
+      sfd.seek(offset)
+      fd.write(sfd.read(4096))
+      fd.flush()
+      self._release.wait(timeout=10)
+      fd.write(sfd.read(size - 4096))
+
+    return size
+
+
+class TestCachedFile(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_path = tempfile.mkdtemp()
+    self.cache_dir = os.path.join(self.tmp_path, 'cache')
+    os.mkdir(self.cache_dir)
+
+    # Compressible content, not aligned to the block size.
+    rng = random.Random(17)
+    words = [rng.randbytes(rng.randint(2, 12)) for _ in range(64)]
+    self.data = b' '.join(rng.choice(words) for _ in range(60000))[: 5 * _BLOCK_SIZE + 123]
+    self.path = os.path.join(self.tmp_path, 'data.bin')
+    with open(self.path, mode='wb') as fd:
+      fd.write(self.data)
+
+    self._cas, self._compress = chf.CachedBlockFile.CAS, chf.CachedBlockFile.COMPRESS
+    self._sparse_pagesize = chf.CachedBlockFile.SPARSE_PAGESIZE
+    chf.clear_block_cache()
+
+  def tearDown(self):
+    chf.CachedBlockFile.CAS, chf.CachedBlockFile.COMPRESS = self._cas, self._compress
+    chf.CachedBlockFile.SPARSE_PAGESIZE = self._sparse_pagesize
+    chf.clear_block_cache()
+    shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+  def _open(self, url=None, reader=None, **kwargs):
+    sres = os.stat(self.path)
+    meta = chf.Meta(size=sres.st_size,
+                    mtime=sres.st_mtime,
+                    tag=ffs.FileReader.tag(sres),
+                    digest=kwargs.pop('digest', None),
+                    block_size=_BLOCK_SIZE)
+    ci = chf.CacheInterface(self.cache_dir)
+
+    return ci.open(url or self.path, meta, reader or ffs.FileReader(self.path),
+                   sparse=kwargs.pop('sparse', False), **kwargs)
+
+  def _check_reads(self, f):
+    self.assertEqual(f.read(100), self.data[: 100])
+    f.seek(2 * _BLOCK_SIZE - 10)
+    self.assertEqual(f.read(20), self.data[2 * _BLOCK_SIZE - 10: 2 * _BLOCK_SIZE + 10])
+    f.seek(0)
+    self.assertEqual(f.read(), self.data)
+
+  def test_roundtrip(self):
+    with self._open() as f:
+      self._check_reads(f)
+
+      self.assertEqual(os.path.getsize(f.cbf.block_key(0)), _BLOCK_SIZE)
+
+  def test_compressed_roundtrip(self):
+    chf.CachedBlockFile.COMPRESS = 'zlib'
+    with self._open() as f:
+      self._check_reads(f)
+
+      self.assertLess(os.path.getsize(f.cbf.block_key(0)), _BLOCK_SIZE)
+
+    chf.clear_block_cache()
+    with self._open() as f:
+      self._check_reads(f)
+
+  def test_cas_compressed(self):
+    # The second URL links the (compressed) blocks stored by the first one.
+    chf.CachedBlockFile.CAS = 1
+    chf.CachedBlockFile.COMPRESS = 'zlib'
+    with self._open(digest='0123') as f:
+      self._check_reads(f)
+
+    chf.clear_block_cache()
+    chf.CachedBlockFile.COMPRESS = ''
+    alias = os.path.join(self.tmp_path, '.', 'data.bin')
+    with self._open(url=alias, digest='0123') as f:
+      self._check_reads(f)
+
+      self.assertEqual(os.stat(f.cbf.block_key(0)).st_nlink, 3)
+
+  def test_sparse_reads(self):
+    page_size = chf.CachedBlockFile.SPARSE_PAGESIZE = 4096
+    reader = _RangeReader(self.path)
+    with self._open(reader=reader, sparse=True) as f:
+      f.seek(10000)
+      self.assertEqual(f.read(100), self.data[10000: 10100])
+      self.assertEqual(reader.ranges, [(2 * page_size, page_size)])
+
+      bpath = f.cbf.block_key(0)
+      self.assertFalse(os.path.exists(bpath))
+      self.assertTrue(os.path.exists(bpath + chf.CachedBlockFile.SPARSE_EXT))
+
+      # Filling all the pages (in non sequential order) promotes the sparse file
+      # to a read-only block file.
+      for offset in reversed(range(0, _BLOCK_SIZE, page_size)):
+        f.seek(offset)
+        self.assertEqual(f.read(page_size), self.data[offset: offset + page_size])
+
+      self.assertEqual(sum(size for _, size in reader.ranges), _BLOCK_SIZE)
+      self.assertEqual(os.stat(bpath).st_mode & 0o777, 0o440)
+      self.assertFalse(os.path.exists(bpath + chf.CachedBlockFile.SPARSE_EXT))
+      self.assertFalse(os.path.exists(bpath + chf.CachedBlockFile.SPARSE_MAP_EXT))
+
+      f.seek(0)
+      self.assertEqual(f.read(), self.data)
+
+  def test_partial_streaming(self):
+    release = threading.Event()
+    reader = _StallingReader(self.path, release)
+    results = []
+
+    def read_head():
+      with self._open(reader=reader) as f:
+        results.append(f.read(1000))
+
+    threads = [threading.Thread(target=read_head) for _ in range(3)]
+    for th in threads:
+      th.start()
+
+    # All the readers start together, before the part file exists, and the ones
+    # not downloading must be served from the part file while the download stalls.
+    quit_time = time.time() + 5
+    while len(results) < len(threads) - 1 and time.time() < quit_time:
+      time.sleep(0.02)
+    streamed = len(results)
+
+    release.set()
+    for th in threads:
+      th.join()
+
+    self.assertEqual(streamed, len(threads) - 1)
+    self.assertEqual(reader.downloads, 1)
+    self.assertEqual(results, [self.data[: 1000]] * len(threads))
+
+
+if __name__ == '__main__':
+  unittest.main()
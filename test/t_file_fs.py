@@ -0,0 +1,67 @@
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock as mock
+
+import py_misc_utils.fs.file_fs as ffs
+
+
+def _no_data(src_fd, dest_fd, offset, count):
+  return 0
+
+
+def _unsupported(src_fd, dest_fd, offset, count):
+  raise OSError('Operation not supported')
+
+
+class TestFileFs(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_path = tempfile.mkdtemp()
+    self.data = os.urandom(3 * 1024**2 + 17)
+    self.path = os.path.join(self.tmp_path, 'data.bin')
+    with open(self.path, mode='wb') as fd:
+      fd.write(self.data)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+  def _copy_fd(self, offset, size):
+    dest_path = os.path.join(self.tmp_path, 'copy.bin')
+    with open(self.path, mode='rb') as sfd, open(dest_path, mode='wb') as dfd:
+      copied = ffs._copy_fd(sfd.fileno(), dfd.fileno(), offset, size)
+
+    with open(dest_path, mode='rb') as fd:
+      return copied, fd.read()
+
+  def test_copy_fd(self):
+    copied, data = self._copy_fd(1000, 2 * 1024**2)
+
+    self.assertEqual(copied, 2 * 1024**2)
+    self.assertEqual(data, self.data[1000: 1000 + 2 * 1024**2])
+
+  def test_copy_fd_fallback(self):
+    # In-kernel copies returning no data (like on procfs), or failing, must fall
+    # back to the next copy method.
+    for copy_file_range, sendfile in ((_no_data, _no_data),
+                                      (_unsupported, _no_data),
+                                      (_no_data, _unsupported)):
+      with (mock.patch.object(ffs, '_copy_file_range', copy_file_range),
+            mock.patch.object(ffs, '_sendfile', sendfile)):
+        copied, data = self._copy_fd(0, len(self.data))
+
+      self.assertEqual(copied, len(self.data))
+      self.assertEqual(data, self.data)
+
+  def test_copy_file(self):
+    dest_path = os.path.join(self.tmp_path, 'dest.bin')
+    for nocache in ('', 'fadvise', 'direct'):
+      ffs.copy_file(self.path, dest_path, nocache=nocache)
+
+      with open(dest_path, mode='rb') as fd:
+        self.assertEqual(fd.read(), self.data)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,73 @@
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock as mock
+
+import py_misc_utils.fs.file_fs as ffs
+import py_misc_utils.gfs_sync as gfss
+
+
+class TestGfsSync(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_path = tempfile.mkdtemp()
+    self.src = os.path.join(self.tmp_path, 'src')
+    self.dest = os.path.join(self.tmp_path, 'dest')
+    self.journal = os.path.join(self.tmp_path, 'sync.journal')
+
+    self.files = dict()
+    for i in range(4):
+      for j in range(5):
+        rpath = os.path.join(f'd{i}', f'f{j}.txt')
+        self.files[rpath] = f'{i}-{j}\n'.encode() * (i + j + 1)
+
+        path = os.path.join(self.src, rpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, mode='wb') as fd:
+          fd.write(self.files[rpath])
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+  def _check_dest(self):
+    for rpath, data in self.files.items():
+      with open(os.path.join(self.dest, rpath), mode='rb') as fd:
+        self.assertEqual(fd.read(), data)
+
+  def test_sync(self):
+    result = gfss.sync(self.src, self.dest, journal=self.journal)
+    self.assertEqual(result.copied, len(self.files))
+    self._check_dest()
+    self.assertFalse(os.path.exists(self.journal))
+
+    result = gfss.sync(self.src, self.dest, journal=self.journal)
+    self.assertEqual(result.copied, 0)
+    self.assertEqual(result.skipped, len(self.files))
+
+  def test_resume(self):
+    copy_file = ffs.copy_file
+    failing = {os.path.join(self.src, 'd1', 'f2.txt'), os.path.join(self.src, 'd3', 'f0.txt')}
+
+    def flaky_copy(src_path, dest_path, **kwargs):
+      if src_path in failing:
+        raise OSError(f'Injected failure: {src_path}')
+
+      return copy_file(src_path, dest_path, **kwargs)
+
+    # Copies everything (even unchanged files) unless recorded in the journal.
+    with mock.patch.object(ffs, 'copy_file', flaky_copy):
+      with self.assertRaises(RuntimeError):
+        gfss.copytree(self.src, self.dest, journal=self.journal)
+
+    self.assertTrue(os.path.exists(self.journal))
+
+    result = gfss.copytree(self.src, self.dest, journal=self.journal)
+    self.assertEqual(result.copied, len(failing))
+    self.assertEqual(result.skipped, len(self.files) - len(failing))
+    self._check_dest()
+    self.assertFalse(os.path.exists(self.journal))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+
+import py_misc_utils.fs_base as fsb
+
+
+class TestMetaCache(unittest.TestCase):
+
+  def _fill(self, mc, entries):
+    for fsid, kind, url in entries:
+      mc.put((fsid, kind, url), url)
+
+  def test_disabled_by_default(self):
+    mc = fsb.MetaCache()
+    mc.put(('s3', 'stat', 's3://b/a'), 'a')
+
+    self.assertIsNone(mc.lookup(('s3', 'stat', 's3://b/a')))
+
+  def test_invalidate(self):
+    mc = fsb.MetaCache(ttl=60, neg_ttl=60)
+    self._fill(mc, (('s3', 'list', 's3://b/'),
+                    ('s3', 'stat', 's3://b/a'),
+                    ('s3', 'list', 's3://b/a/'),
+                    ('s3', 'list', 's3://b/a/b'),
+                    ('s3', 'stat', 's3://b/a/b/c'),
+                    ('s3', 'stat', 's3://b/a/bb'),
+                    ('s3', 'stat', 's3://b/x'),
+                    ('gs', 'stat', 's3://b/a')))
+
+    # A new key drops the listings (and stats) of all its ancestors.
+    mc.invalidate('s3', 's3://b/a/b/new')
+    for key in (('s3', 'list', 's3://b/'),
+                ('s3', 'stat', 's3://b/a'),
+                ('s3', 'list', 's3://b/a/'),
+                ('s3', 'list', 's3://b/a/b')):
+      self.assertIsNone(mc.lookup(key))
+    for key in (('s3', 'stat', 's3://b/a/b/c'),
+                ('s3', 'stat', 's3://b/a/bb'),
+                ('s3', 'stat', 's3://b/x'),
+                ('gs', 'stat', 's3://b/a')):
+      self.assertEqual(mc.lookup(key), key[2])
+
+    # Dropping a directory drops everything below it.
+    mc.invalidate('s3', 's3://b/a')
+    self.assertIsNone(mc.lookup(('s3', 'stat', 's3://b/a/b/c')))
+    self.assertIsNone(mc.lookup(('s3', 'stat', 's3://b/a/bb')))
+    self.assertEqual(mc.lookup(('s3', 'stat', 's3://b/x')), 's3://b/x')
+    self.assertEqual(mc.lookup(('gs', 'stat', 's3://b/a')), 's3://b/a')
+
+  def test_max_size(self):
+    mc = fsb.MetaCache(ttl=60, max_size=10)
+    for i in range(100):
+      mc.put(('file', 'stat', f'/d{i % 3}/f{i}'), i)
+
+    self.assertIsNone(mc.lookup(('file', 'stat', '/d0/f0')))
+    self.assertEqual(mc.lookup(('file', 'stat', '/d0/f99')), 99)
+
+    mc.invalidate('file', '/d0')
+    self.assertIsNone(mc.lookup(('file', 'stat', '/d0/f99')))
+    self.assertEqual(mc.lookup(('file', 'stat', '/d1/f97')), 97)
+
+
+if __name__ == '__main__':
+  unittest.main()